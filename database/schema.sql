@@ -36,3 +36,57 @@ CREATE TABLE IF NOT EXISTS member_ranking (
     last_flag_date INT,
     respects INT
 );
+
+CREATE TABLE IF NOT EXISTS replicas (
+    replica_id TEXT PRIMARY KEY,
+    heartbeat REAL
+);
+
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT,
+    expires REAL
+);
+
+INSERT INTO leases (name, holder, expires)
+SELECT 'leader', '', 0 WHERE NOT EXISTS (SELECT 1 FROM leases WHERE name = 'leader');
+
+CREATE TABLE IF NOT EXISTS notification_queue (
+    queue_key TEXT PRIMARY KEY,
+    member_id INT,
+    member_name TEXT,
+    activity_data TEXT,
+    queued_at REAL,
+    delivered INT
+);
+
+CREATE TABLE IF NOT EXISTS member_snapshots (
+    id INT,
+    snapshot_time REAL,
+    rank INT,
+    user_owns INT,
+    system_owns INT,
+    challenge_owns INT,
+    fortress_owns INT,
+    endgame_owns INT,
+    prolabs_owns INT,
+    user_bloods INT,
+    system_bloods INT,
+    respects INT
+);
+
+CREATE TABLE IF NOT EXISTS bot_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS member_solves (
+    member_id INT,
+    member_name TEXT,
+    solve_date TEXT,
+    object_type TEXT,
+    type TEXT,
+    name TEXT,
+    challenge_category TEXT,
+    flag_title TEXT
+);
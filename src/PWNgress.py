@@ -1,17 +1,23 @@
 from collections import OrderedDict
-from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import argparse
 import io
-import json
+import math
 import os
 import re
 import requests
+import socket
 import textwrap
 import time
 import traceback
 
-from lumberjack.lumberjack import Lumberjack
 from utils.utils import read_settings_file, create_sha256_hash
+from utils import htb_models
+from utils.async_log import AsyncLog
+from utils.coordinator import LocalCoordinator, DatabaseCoordinator
+from utils.health import Heartbeat, Watchdog, serve_health
+from utils.stats_api import StatsAPI
 from SQLWizard.sqlwizard import SQLWizard
 
 
@@ -22,10 +28,21 @@ class PWNgress():
 
     def __init__(self, htb_app_token, htb_team_id, discord_webhook_url_team, discord_webhook_url_alerts,
                  font_htb_name, font_message, htb_users_to_ignore, font_table_header, font_table_names,
-                 font_table_data):
-        self.log = Lumberjack("../logs/PWNgress_events.log", False)
-
-        self.db = SQLWizard("../database/PWNgress.sqlite")
+                 font_table_data, connect_timeout=5, read_timeout=30, cycle_deadline=600,
+                 coordinator_type="local", replica_id="", lease_seconds=1200, snapshots_per_cycle=2,
+                 snapshot_interval=12 * 3600, snapshot_max_age=24 * 3600, image_format="png",
+                 images_dir="../images", dry_run=False, max_queue_size=500,
+                 log_path="../logs/PWNgress_events.log", database_path="../database/PWNgress.sqlite",
+                 polling_mode="member", team_feed_page_size=100, team_feed_max_entries=800,
+                 ranking_page_size=25, render_workers=4, log_level="DEBUG", log_max_bytes=10 * 1024 * 1024,
+                 log_backup_count=5, coalesce_window=600, health_port=8080, phase_timeout=900,
+                 watchdog_action="exit", catchup_min_gap=2 * 3600, catchup_max_pages=10,
+                 catchup_digest_threshold=20, catchup_batch_size=5, catchup_batch_delay=5,
+                 embed_mode_queue_size=30, embed_mode_age=600, stats_api_port=0):
+        self.log = AsyncLog(log_path, log_level, log_max_bytes, log_backup_count)
+
+        self.db = SQLWizard(database_path)
+        self.database_path = database_path
 
         self.log.info("PWNgress started")
 
@@ -39,46 +56,264 @@ class PWNgress():
         self.font_table_header = font_table_header
         self.font_table_names = font_table_names
         self.font_table_data = font_table_data
+        self.images_dir = images_dir
+        # Encoding of uploaded images, one of image_encoding.IMAGE_FORMATS
+        self.image_format = image_format
+        # Members per ranking image and threads used to download avatars and render ranking pages
+        self.ranking_page_size = int(ranking_page_size)
+        self.render_workers = int(render_workers)
+        self.render_executor = None
+
+        # (connect, read) timeout used for every HTB and Discord request
+        self.request_timeout = (float(connect_timeout), float(read_timeout))
+        # Seconds one polling cycle may take. Members not polled in time are carried over to the next cycle
+        self.cycle_deadline = float(cycle_deadline)
+        self.cycle_deadline_time = None
+        self.carry_over_member_ids = []
+        self.sync_carry_over_member_ids = []
+        self.deadline_misses = 0
+
+        # "member" - request activities of every member, "team" - use team activity feed and request
+        # activities only of members the feed doesn't cover
+        self.polling_mode = polling_mode
+        self.team_feed_page_size = int(team_feed_page_size)
+        self.team_feed_max_entries = int(team_feed_max_entries)
+
+        # Weekly ranking data is collected gradually (see collect_member_snapshots)
+        self.snapshots_per_cycle = int(snapshots_per_cycle)
+        self.snapshot_interval = float(snapshot_interval)
+        self.snapshot_max_age = float(snapshot_max_age)
+
+        # Don't send anything to Discord and don't change notification state (CLI --dry-run)
+        self.dry_run = dry_run
+
+        # Split polling between replicas and elect a leader for ranking and notifications. Dry run doesn't
+        # register as a replica or take the lease (running replicas would reshard around it), it checks all
+        # members as a single replica
+        if coordinator_type == "database" and not self.dry_run:
+            self.coordinator = DatabaseCoordinator(self.db, self.log, replica_id or socket.gethostname(), lease_seconds)
+        elif coordinator_type == "database":
+            self.coordinator = LocalCoordinator(replica_id or socket.gethostname())
+        else:
+            self.coordinator = LocalCoordinator()
 
+        # Maximum number of messages kept in memory (see check_each_team_member_solves)
+        self.max_queue_size = int(max_queue_size)
         self.message_queue = {}
-
-        self.loop()
+        # Solves of one member within this many seconds are sent as one message (0 - every solve separately)
+        self.coalesce_window = float(coalesce_window)
+
+        # Catch-up after downtime: a gap longer than catchup_min_gap since the last solves check. Activities
+        # are paged back to the last notified solve (at most catchup_max_pages) and missed solves are sent in
+        # batches with a pause or, if there are more than catchup_digest_threshold, as one summary
+        self.catchup_min_gap = float(catchup_min_gap)
+        self.catchup_max_pages = int(catchup_max_pages)
+        self.catchup_digest_threshold = int(catchup_digest_threshold)
+        self.catchup_batch_size = int(catchup_batch_size)
+        self.catchup_batch_delay = float(catchup_batch_delay)
+        self.catchup_gap = 0
+
+        # Under burst load (queue of embed_mode_queue_size messages or oldest message waiting embed_mode_age
+        # seconds) solves are sent as Discord embeds instead of rendered images. 0 disables the threshold
+        self.embed_mode_queue_size = int(embed_mode_queue_size)
+        self.embed_mode_age = float(embed_mode_age)
+        self.embed_mode = False
+        # {queue_key: time} when a solve was queued first, kept until it's delivered (age of the queue)
+        self.first_queued_times = {}
+
+        # Progress of the loop for the health endpoint and the watchdog. A phase running longer than
+        # phase_timeout means the loop is stuck. watchdog_action - "alert" or "exit" (restart by Docker)
+        self.heartbeat = Heartbeat(phase_timeout)
+        self.health_port = int(health_port)
+        self.watchdog_action = watchdog_action
+
+        # Read-only JSON API over the database for other tools (STATS_API_PORT, 0 disables it)
+        self.stats_api_port = int(stats_api_port)
+        self.stats_api = None
+
+        # Restore state saved by the previous run
+        self.carry_over_member_ids = [int(x) for x in self.get_state("carry_over_member_ids").split(",") if x]
+        self.sync_carry_over_member_ids = [
+            int(x) for x in self.get_state("sync_carry_over_member_ids").split(",") if x
+        ]
 
     def loop(self):
         """
         Core part of the script. Currently, only tracking team activities is implemented.
         """
 
-        last_rank_check_date = ""
+        self.start_health_monitoring()
+        self.start_stats_api()
+
         while True:
-            self.get_and_save_team_members()
-            self.check_each_team_member_solves()
-            self.send_member_solves_messages()
-
-            # Only run once a week at 01:00 UTC
-            if datetime.today().weekday() == 5:
-                if datetime.now().time().strftime("%H") == "01":
-                    current_date = datetime.now().strftime("%Y-%m-%d")
-                    self.log.debug("Starting ranking check")
-                    self.log.debug("    Current date   : {}".format(current_date))
-                    self.log.debug("    Last check date: {}".format(last_rank_check_date))
-                    if current_date != last_rank_check_date:
-                        self.get_team_ranking()
-                        self.get_members_ranking()
-                        self.send_ranking_message()
-                        last_rank_check_date = current_date
+            self.run_cycle()
 
             # We don't want to check pwns every minute through the week. Check pwns every minute from
             # Sat 19:00 UTC to Sun 07:00. On all other days check every 30 minutes
-            self.log.debug("Day - {}".format(datetime.today().weekday()))
-            self.log.debug("Hour - {}".format(int(datetime.now().time().strftime("%H"))))
+            self.log.debug("Day - {}", datetime.today().weekday())
+            self.log.debug("Hour - {}", int(datetime.now().time().strftime("%H")))
             if datetime.today().weekday() == 5 and int(datetime.now().time().strftime("%H")) >= 19 or\
                datetime.today().weekday() == 6 and int(datetime.now().time().strftime("%H")) <= 7:
-                self.log.info("Sleeping for {} sec".format(60))
-                time.sleep(60)
+                self.sleep(60)
             else:
-                self.log.info("Sleeping for {} sec".format(60 * 30))
-                time.sleep(60 * 30)
+                self.sleep(60 * 30)
+
+    def sleep(self, sleep_seconds):
+        """
+        Sleep between cycles. Sleeps in slices of a minute and keeps the replica alive, so other replicas
+        don't take over its members or leadership.
+        """
+
+        self.log.info("Sleeping for {} sec", sleep_seconds)
+        self.heartbeat.sleeping(sleep_seconds)
+
+        sleep_until = time.monotonic() + sleep_seconds
+        while time.monotonic() < sleep_until:
+            time.sleep(max(min(sleep_until - time.monotonic(), 60), 0))
+            self.keep_alive()
+
+    def start_health_monitoring(self):
+        """
+        Start health endpoint (HEALTH_PORT, 0 disables it) and the watchdog thread.
+        """
+
+        if self.health_port:
+            try:
+                serve_health(self.heartbeat, port=self.health_port)
+                self.log.info("Health endpoint listening on port {}", self.health_port)
+            except OSError as err:
+                self.error_handler("Failed to start health endpoint " + str(err), traceback.format_exc())
+
+        Watchdog(self.heartbeat, self.handle_stall)
+
+    def start_stats_api(self):
+        """
+        Start the stats API if STATS_API_PORT is set.
+        """
+
+        if not self.stats_api_port:
+            return
+
+        try:
+            self.stats_api = StatsAPI(self.database_path)
+            self.stats_api.serve(port=self.stats_api_port)
+            self.log.info("Stats API listening on port {}", self.stats_api_port)
+        except Exception as err:
+            self.stats_api = None
+            self.error_handler("Failed to start stats API " + str(err), traceback.format_exc())
+
+    def handle_stall(self, health_status):
+        """
+        Called by the watchdog thread when the loop stopped making progress. Sends an alert and with
+        WATCHDOG_ACTION=exit exits the process, so Docker restarts the container.
+        """
+
+        self.error_handler(
+            "PWNgress is stuck in phase '{}' for {} sec".format(
+                health_status["current_phase"], health_status["seconds_since_last_beat"]
+            ),
+            htb_models.dumps(health_status)
+        )
+
+        if self.watchdog_action == "exit":
+            self.log.error("Watchdog is exiting the process")
+            self.log.close()
+            # sys.exit would only end the watchdog thread
+            os._exit(1)
+
+    def start_cycle(self):
+        """
+        Start cycle deadline and refresh replica coordination. Called before any phase is run.
+        """
+
+        self.cycle_deadline_time = time.monotonic() + self.cycle_deadline
+        self.coordinator.start_cycle()
+
+    def keep_alive(self):
+        """
+        Renew replica heartbeat and the leader lease (see DatabaseCoordinator.keep_alive).
+        """
+
+        try:
+            self.coordinator.keep_alive()
+        except Exception as err:
+            self.error_handler("Failed to renew replica lease " + str(err), traceback.format_exc())
+
+    def run_cycle(self):
+        """
+        Run one polling cycle and the weekly ranking if it's due.
+        """
+
+        self.start_cycle()
+
+        self.run_phase("sync", self.get_and_save_team_members)
+        self.run_phase("poll", self.check_each_team_member_solves)
+        self.run_phase("send", self.send_member_solves_messages)
+        self.run_phase("snapshots", self.collect_member_snapshots)
+
+        # Only run once a week on Saturday from 01:00 UTC (on the leader replica). A ranking missed at 01:00
+        # (e.g. new leader elected later) is run as soon as possible that day
+        if datetime.today().weekday() == 5 and self.coordinator.is_leader():
+            if int(datetime.now().time().strftime("%H")) >= 1:
+                current_date = datetime.now().strftime("%Y-%m-%d")
+                last_rank_check_date = self.get_state("last_rank_check_date")
+                self.log.debug("Starting ranking check")
+                self.log.debug("    Current date   : {}", current_date)
+                self.log.debug("    Last check date: {}", last_rank_check_date)
+                if current_date != last_rank_check_date:
+                    self.run_phase("ranking", self.run_weekly_ranking)
+                    self.set_state("last_rank_check_date", current_date)
+
+        self.heartbeat.cycle_finished()
+
+    def run_weekly_ranking(self):
+        """
+        Save team and members ranking and send the ranking table.
+        """
+
+        self.get_team_ranking()
+        self.get_members_ranking()
+        self.send_ranking_message()
+
+    def run_phase(self, phase_name, phase_function):
+        """
+        Run one phase of the cycle, report it to the heartbeat and log how long it took. Returns duration
+        in seconds.
+        """
+
+        self.heartbeat.phase_started(phase_name)
+        phase_start = time.perf_counter()
+        phase_function()
+        phase_duration = time.perf_counter() - phase_start
+        self.heartbeat.phase_finished(phase_name)
+        self.keep_alive()
+        # Phases write to the database, cached API responses are outdated
+        if self.stats_api:
+            self.stats_api.invalidate()
+        self.log.info("Phase {} finished in {:.2f} sec", phase_name, phase_duration)
+
+        return phase_duration
+
+    def get_state(self, key, default=""):
+        """
+        Get value saved in bot_state table.
+        """
+
+        state_rows = self.db.select("value", "bot_state", "key = '{}'".format(key))
+
+        return state_rows[0][0] if state_rows else default
+
+    def set_state(self, key, value):
+        """
+        Save value to bot_state table, so it survives restarts and one-shot CLI runs. Dry run doesn't
+        change the state.
+        """
+
+        if self.dry_run:
+            return
+
+        self.db.delete("bot_state", "key = '{}'".format(key))
+        self.db.insert("bot_state", OrderedDict([("key", key), ("value", str(value))]))
 
     def error_handler(self, error_message, traceback_message):
         """
@@ -98,11 +333,74 @@ class PWNgress():
                            traceback_message[:1000] + "...\n...```"
             }
 
-            req = requests.post(self.discord_webhook_url_alerts, headers=headers, json=message_data)
+            req = self.post_webhook(self.discord_webhook_url_alerts, headers=headers, json=message_data)
         except Exception as err:
-            self.log.error("Failed to send an alert message " + str(err))
+            self.log.error("Failed to send an alert message {}", err)
             self.log.error(traceback.format_exc())
 
+    def deadline_exceeded(self):
+        """
+        Check if the current polling cycle ran out of its time budget (CYCLE_DEADLINE).
+        """
+
+        return self.cycle_deadline_time is not None and time.monotonic() > self.cycle_deadline_time
+
+    def carry_over_position(self, carry_over_member_ids, member_id):
+        """
+        Sort key of a member: position in carry_over_member_ids, members that were not carried over go last.
+        Keeps the order of carried over members, so the same members aren't skipped every cycle.
+        """
+
+        if member_id in carry_over_member_ids:
+            return carry_over_member_ids.index(member_id)
+
+        return len(carry_over_member_ids)
+
+    def report_deadline_miss(self, phase, skipped_count):
+        """
+        Log members skipped because of the cycle deadline. Alert only on the first miss after a
+        cycle that finished in time so weekend (1 minute) cycles don't flood the alerts channel.
+        """
+
+        self.log.warning(
+            "Cycle deadline of {} sec exceeded in {}, {} members carried over",
+            self.cycle_deadline, phase, skipped_count
+        )
+        self.deadline_misses += 1
+        if self.deadline_misses == 1:
+            self.error_handler(
+                "Cycle deadline of {} sec exceeded in {}, {} members carried over".format(
+                    self.cycle_deadline, phase, skipped_count
+                ),
+                ""
+            )
+
+    def post_webhook(self, webhook_url, **kwargs):
+        """
+        Send Discord webhook request. In dry run the request is only logged.
+        """
+
+        if self.dry_run:
+            self.log.info("Dry run, not sending Discord message ({})", ", ".join(kwargs))
+            return None
+
+        return requests.post(webhook_url, timeout=self.request_timeout, **kwargs)
+
+    def get_htb_data(self, api_path):
+        """
+        Request HTB API endpoint and return raw response body. Decoding is done by htb_models.
+        """
+
+        headers = {
+            "Authorization": "Bearer " + self.htb_app_token,
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
+                          "Gecko/20100101 Firefox/111.0"
+        }
+
+        req = requests.get(htb_models.HTB_URL + api_path, headers=headers, timeout=self.request_timeout)
+
+        return req.content
+
     def get_and_save_team_members(self):
         """
         Get all team members and save them to the local database.
@@ -111,99 +409,88 @@ class PWNgress():
         self.log.info("Getting team members")
 
         try:
-            team_members_link = "https://www.hackthebox.com" \
-                                    "/api/v4/team/members/{}".format(self.htb_team_id)
-
-            headers = {
-                "Authorization": "Bearer " + self.htb_app_token,
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
-                              "Gecko/20100101 Firefox/111.0"
-            }
-
-            req = requests.get(team_members_link, headers=headers)
-            team_members_json_data = json.loads(req.text)
+            team_members = htb_models.parse_team_members(
+                self.get_htb_data("/api/v4/team/members/{}".format(self.htb_team_id))
+            )
         except Exception as err:
             self.error_handler("Failed to get team members " + str(err), traceback.format_exc())
             return
 
-        # with open("test/test_team_members.json", "w") as f:
-        #     json.dump(team_members_json_data, f)
-        # with open("test/test_team_members.json", "r") as f:
-        #     team_members_json_data = json.load(f)
-
         all_member_ids = [x[0] for x in self.db.select("id", "htb_team_members")]
 
-        for member_data in team_members_json_data:
+        # Members not synced in the previous cycle go first, in the order they were carried over
+        sync_order = sorted(
+            team_members, key=lambda member: self.carry_over_position(self.sync_carry_over_member_ids, member.id)
+        )
+        self.sync_carry_over_member_ids = []
+
+        for member in sync_order:
             # Ignore inactive users
-            if str(member_data["id"]) in self.htb_users_to_ignore:
-                self.log.debug("Ignoring user {} ({})".format(
-                    member_data["name"],
-                    member_data["id"]
-                ))
+            if str(member.id) in self.htb_users_to_ignore:
+                self.log.debug("Ignoring user {} ({})", member.name, member.id)
+                continue
+            # Member is polled by another replica
+            if not self.coordinator.owns_member(member.id):
+                continue
+            # Out of time for this cycle. Known members keep their current rank until the next cycle,
+            # new members are still added so their solves can be tracked
+            if member.id in all_member_ids and self.deadline_exceeded():
+                self.sync_carry_over_member_ids.append(member.id)
                 continue
             # Because of an issue with HTB APIs all ranks are set to "unranked"
             # We need to manually pull ranks from the members API instead of team API
             try:
-                member_basic_link = "https://www.hackthebox.com" \
-                                    "/api/v4/user/profile/basic/{}".format(member_data["id"])
-                headers = {
-                    "Authorization": "Bearer " + self.htb_app_token,
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
-                                  "Gecko/20100101 Firefox/111.0"
-                }
-
-                req = requests.get(member_basic_link, headers=headers)
-                member_basic_data = json.loads(req.text)
-
+                member_basic = htb_models.parse_profile_basic(
+                    self.get_htb_data("/api/v4/user/profile/basic/{}".format(member.id))
+                )
             except Exception as err:
                 self.error_handler("Failed to get member rank data (fix) " + str(err), traceback.format_exc())
+                self.set_state(
+                    "sync_carry_over_member_ids", ",".join(str(x) for x in self.sync_carry_over_member_ids)
+                )
                 return
 
-            member_rank = member_basic_data["profile"]["ranking"]
-
             # Check if the team member is already in the database
-            if member_data["id"] in all_member_ids:
-                self.log.debug("Team member {} ({}) already in the database".format(
-                    member_data["name"],
-                    member_data["id"]
-                ))
+            if member.id in all_member_ids:
+                self.log.debug("Team member {} ({}) already in the database", member.name, member.id)
                 self.db.update(
                     "htb_team_members",
                     OrderedDict([
-                        ("htb_name", member_data["name"]),
-                        ("htb_avatar", "https://www.hackthebox.com" + member_data["avatar"]),
-                        ("points", member_data["points"]),
-                        ("rank", member_rank),
-                        # ("rank", member_data["rank"]),
-                        ("json_data", json.dumps(member_data))
+                        ("htb_name", member.name),
+                        ("htb_avatar", member.avatar),
+                        ("points", member.points),
+                        ("rank", member_basic.ranking),
+                        ("json_data", member.to_json())
                     ]),
-                    "id = '{}'".format(member_data["id"])
+                    "id = '{}'".format(member.id)
                 )
             else:
-                self.log.debug("Adding new team member {} ({})".format(
-                    member_data["name"],
-                    member_data["id"]
-                ))
+                self.log.debug("Adding new team member {} ({})", member.name, member.id)
                 self.db.insert(
                     "htb_team_members",
                     OrderedDict([
-                        ("id", member_data["id"]),
-                        ("htb_name", member_data["name"]),
+                        ("id", member.id),
+                        ("htb_name", member.name),
                         ("discord_name", ""),  # Leave discord name empty
-                        ("htb_avatar", "https://www.hackthebox.com" + member_data["avatar"]),
+                        ("htb_avatar", member.avatar),
                         ("last_flag_date", ""),  # Leave last flag empty as we don't know it yet
-                        ("points", member_data["points"]),
-                        ("rank", member_rank),
-                        # ("rank", member_data["rank"]),
-                        ("json_data", json.dumps(member_data))
+                        ("points", member.points),
+                        ("rank", member_basic.ranking),
+                        ("json_data", member.to_json())
                     ])
                 )
 
-        # Check if we need to delete any users (user left the team)
-        all_members_in_htb = [member_data["id"] for member_data in team_members_json_data]
+        self.set_state("sync_carry_over_member_ids", ",".join(str(x) for x in self.sync_carry_over_member_ids))
+        if self.sync_carry_over_member_ids:
+            self.report_deadline_miss("team members sync", len(self.sync_carry_over_member_ids))
+
+        # Check if we need to delete any users (user left the team). Only the leader removes members
+        if not self.coordinator.is_leader():
+            return
+        all_members_in_htb = [member.id for member in team_members]
         users_to_remove = list(set(all_member_ids) - set(all_members_in_htb))
         for user_to_remove in users_to_remove:
-            self.log.warning("Deleting user {}".format(user_to_remove))
+            self.log.warning("Deleting user {}", user_to_remove)
             self.db.delete(
                 "htb_team_members",
                 "id = '{}'".format(user_to_remove)
@@ -216,32 +503,79 @@ class PWNgress():
 
         self.log.info("Checking team members solves")
 
-        # Get all team members from the database
-        found_member_rows = self.db.select("id, htb_name, last_flag_date", "htb_team_members")
+        # Every replica checks its own members
+        check_time_key = "last_solves_check_time_{}".format(self.coordinator.replica_id)
+        last_check_time = float(self.get_state(check_time_key) or 0)
+        self.catchup_gap = time.time() - last_check_time if last_check_time else 0
+        if self.catchup_gap > self.catchup_min_gap:
+            self.log.warning("Last solves check was {:.0f} sec ago, catching up", self.catchup_gap)
+        else:
+            # Catch-up continues while members are carried over (full queue or deadline)
+            self.catchup_gap = float(self.get_state("catchup_gap") or 0)
+
+        # Get all team members from the database. Members carried over from the previous cycle go first,
+        # in the order they were carried over
+        found_member_rows = sorted(
+            self.db.select("id, htb_name, last_flag_date", "htb_team_members"),
+            key=lambda row: self.carry_over_position(self.carry_over_member_ids, row[0])
+        )
+        # Members with solves older than the last check that were not notified yet
+        lagging_member_ids = set(self.carry_over_member_ids) | {
+            int(x) for x in self.get_state("undelivered_member_ids").split(",") if x
+        }
+        self.carry_over_member_ids = []
+
+        # In team polling mode most members are checked with the team activity feed
+        feed_activities = {}
+        if self.polling_mode == "team":
+            feed_activities = self.get_team_activities(found_member_rows, last_check_time, lagging_member_ids)
+
+        backpressure_count = 0
+        failed_count = 0
         for found_member_row in found_member_rows:
             member_id = found_member_row[0]
             member_name = found_member_row[1]
             member_last_flag_date = found_member_row[2]
 
-            member_solves_json = self.get_user_activities(member_name, member_id)
-            # with open("test/test_member_activity_{}.json".format(member_id), "w") as f:
-            #     json.dump(member_solves_json, f)
-            # with open("test/test_member_activity_{}.json".format(member_id), "r") as f:
-            #     member_solves_json = json.load(f)
+            # Member is polled by another replica
+            if not self.coordinator.owns_member(member_id):
+                continue
+
+            # Backpressure: with a full queue new solves stay in HTB until the queue is sent.
+            # last_flag_date is not changed, so they are found again in the next cycle
+            if len(self.message_queue) >= self.max_queue_size:
+                self.carry_over_member_ids.append(member_id)
+                backpressure_count += 1
+                continue
+
+            if member_id in feed_activities:
+                member_activities = feed_activities[member_id]
+            else:
+                if self.deadline_exceeded():
+                    self.carry_over_member_ids.append(member_id)
+                    continue
+
+                member_activities = self.get_user_activities(member_name, member_id)
 
-            if member_solves_json == "":
+            # Request failed. The member stays lagging, so the team feed doesn't cover it until its last
+            # flag is in the feed (the feed only reaches back to the last check)
+            if member_activities is None:
+                self.carry_over_member_ids.append(member_id)
+                failed_count += 1
                 continue
 
-            if len(member_solves_json["profile"]["activity"]) == 0:
+            if len(member_activities) == 0:
                 continue
 
             # If member is new and we didn't record the last flag yet, don't go through each
             # activity and just save the last one
             if member_last_flag_date == "":
+                if self.dry_run:
+                    continue
                 self.db.update(
                     "htb_team_members",
                     OrderedDict([
-                        ("last_flag_date", member_solves_json["profile"]["activity"][0]["date"])
+                        ("last_flag_date", member_activities[0].date)
                     ]),
                     "id = '{}'".format(member_id)
                 )
@@ -251,92 +585,339 @@ class PWNgress():
             date_format = "%Y-%m-%dT%H:%M:%S.%fZ"
             last_flag_date_from_db = datetime.strptime(member_last_flag_date, date_format)
 
-            for activity_data in reversed(member_solves_json["profile"]["activity"]):
-                last_flag_date_from_api = datetime.strptime(activity_data["date"], date_format)
+            # All activities on the first page are new, older ones are on the next pages
+            if member_id not in feed_activities:
+                member_activities = self.get_missed_activities(
+                    member_name, member_id, member_activities, last_flag_date_from_db
+                )
+                if member_activities is None:
+                    self.carry_over_member_ids.append(member_id)
+                    if not self.deadline_exceeded():
+                        failed_count += 1
+                    continue
+
+            for activity_data in reversed(member_activities):
+                last_flag_date_from_api = datetime.strptime(activity_data.date, date_format)
 
                 if last_flag_date_from_api > last_flag_date_from_db:
                     # Temporary store all messages that we will send. Later we will sort them.
                     # This will allow us to create notification in order in which the flags were obtained
-                    self.message_queue["{}_{}".format(last_flag_date_from_api.timestamp(), member_id)] = {
+                    queue_key = "{}_{}".format(last_flag_date_from_api.timestamp(), member_id)
+                    self.message_queue[queue_key] = {
                         "member_id": member_id,
                         "member_name": member_name,
-                        "activity_data": activity_data
+                        "activity_data": activity_data,
+                        # Not sent solves are found again, keep the time they were found first
+                        "queued_at": self.first_queued_times.setdefault(queue_key, time.time())
                     }
 
-    def get_user_activities(self, member_name, user_id):
+        self.set_state("carry_over_member_ids", ",".join(str(x) for x in self.carry_over_member_ids))
+        self.set_state(check_time_key, time.time())
+        self.set_state("catchup_gap", self.catchup_gap if self.carry_over_member_ids else "")
+        if backpressure_count:
+            self.log.warning(
+                "Message queue is full ({}), {} members carried over",
+                len(self.message_queue), backpressure_count
+            )
+        if failed_count:
+            self.log.warning("Activities of {} members failed to load, carried over", failed_count)
+        if len(self.carry_over_member_ids) > backpressure_count + failed_count:
+            self.report_deadline_miss(
+                "solves check", len(self.carry_over_member_ids) - backpressure_count - failed_count
+            )
+        else:
+            self.deadline_misses = 0
+
+    def get_team_activities(self, found_member_rows, last_check_time, lagging_member_ids):
         """
-        Get user activities.
+        Get team activity feed and return activities of the members it covers as {member_id: [Activity, ...]}
+        (newest first). If the feed reaches back to the last solves check (last_check_time), it contains
+        every solve since then and all members with a recorded last flag are covered; members without
+        activities in the feed have nothing new. Members in lagging_member_ids (carried over or with solves
+        not delivered in the last cycle) can have older new solves and are covered only if the feed reaches
+        their last flag. The feed is requested with TEAM_FEED_PAGE_SIZE entries and
+        the size is doubled (up to TEAM_FEED_MAX_ENTRIES) until it reaches the last check. If it doesn't
+        (e.g. after downtime) only members whose last flag is in the feed are covered, others are polled per user.
         """
 
-        self.log.debug("Checking user activities {} ({})".format(member_name, user_id))
+        date_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+        # Activity dates are UTC. Solves can show up in the feed a bit later, so the feed has to overlap
+        # the last check
+        feed_needed_since = None
+        if last_check_time:
+            feed_needed_since = datetime.fromtimestamp(last_check_time - 3600, timezone.utc).replace(tzinfo=None)
 
-        try:
-            team_activity_link = "https://www.hackthebox.com" \
-                                 "/api/v4/user/profile/activity/{}".format(user_id)
+        entries_count = self.team_feed_page_size
+        feed_since_last_check = False
+        while True:
+            self.log.debug("Checking team activities ({} entries)", entries_count)
+            try:
+                team_activities = htb_models.parse_team_activities(
+                    self.get_htb_data("/api/v4/team/activity/{}?n={}".format(self.htb_team_id, entries_count))
+                )
+            except Exception as err:
+                self.error_handler("Failed to get team activities " + str(err), traceback.format_exc())
+                return {}
 
-            headers = {
-                "Authorization": "Bearer " + self.htb_app_token,
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
-                              "Gecko/20100101 Firefox/111.0"
-            }
+            team_activities.sort(key=lambda x: datetime.strptime(x[1].date, date_format), reverse=True)
+            # Feed returned less than requested, so it contains all team activities
+            feed_has_all = len(team_activities) < entries_count
+            if feed_has_all:
+                break
+            oldest_feed_date = datetime.strptime(team_activities[-1][1].date, date_format)
+            feed_since_last_check = bool(feed_needed_since) and oldest_feed_date <= feed_needed_since
+            if feed_since_last_check:
+                break
+            if not feed_needed_since or entries_count >= self.team_feed_max_entries:
+                break
+            entries_count = min(entries_count * 2, self.team_feed_max_entries)
+
+        member_activities = {}
+        for member_id, activity_data in team_activities:
+            member_activities.setdefault(member_id, []).append(activity_data)
+
+        feed_activities = {}
+        for found_member_row in found_member_rows:
+            member_id = found_member_row[0]
+            member_last_flag_date = found_member_row[2]
+            # New members are polled per user to record their last flag
+            if member_last_flag_date == "":
+                continue
+            if feed_has_all or feed_since_last_check and member_id not in lagging_member_ids or \
+                    oldest_feed_date <= datetime.strptime(member_last_flag_date, date_format):
+                feed_activities[member_id] = member_activities.get(member_id, [])
+
+        self.log.debug("Team activities cover {} of {} members", len(feed_activities), len(found_member_rows))
+
+        return feed_activities
+
+    def get_user_activities(self, member_name, user_id, page=1):
+        """
+        Get user activities. Returns list of htb_models.Activity (newest first) or None on failure.
+        """
 
-            req = requests.get(team_activity_link, headers=headers)
-            user_activities = json.loads(req.text)
+        self.log.debug("Checking user activities {} ({}), page {}", member_name, user_id, page)
 
-            # self.log.debug("Found {} activities".format(len(user_activities["profile"]["activity"])))
+        api_path = "/api/v4/user/profile/activity/{}".format(user_id)
+        if page > 1:
+            api_path += "?page={}".format(page)
 
-            return user_activities
+        try:
+            return htb_models.parse_activities(self.get_htb_data(api_path))
         except Exception as err:
             self.error_handler("Failed to get member activities " + str(err), traceback.format_exc())
-            return ""
+            return None
 
-    def get_team_ranking(self):
+    def get_missed_activities(self, member_name, user_id, member_activities, last_flag_date):
         """
+        Page back through user activities until the last notified solve (last_flag_date) is reached, so no
+        solve is lost when a member solved more than one page since the last check (e.g. after downtime).
+        Stops after CATCHUP_MAX_PAGES pages or when a page has no older activities. Returns activities
+        (newest first) or None if a page failed to load or the cycle deadline was reached before paging
+        finished, so the member is checked again in the next cycle.
         """
 
-        self.log.info("Getting team ranking")
+        date_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+        page = 1
+        oldest_date = datetime.strptime(member_activities[-1].date, date_format)
+        while oldest_date > last_flag_date:
+            if page >= self.catchup_max_pages:
+                self.log.warning(
+                    "Activities of {} ({}) older than {} pages are not checked", member_name, user_id, page
+                )
+                break
+            if self.deadline_exceeded():
+                return None
+
+            page += 1
+            page_activities = self.get_user_activities(member_name, user_id, page)
+            if page_activities is None:
+                return None
+
+            older_activities = [x for x in page_activities if datetime.strptime(x.date, date_format) < oldest_date]
+            if not older_activities:
+                # HTB has no older activities (or ignored the page), solves since the last flag can be missing
+                self.log.warning(
+                    "Activities of {} ({}) end on page {} before the last notified solve", member_name, user_id, page
+                )
+                break
 
-        try:
-            team_info_link = "https://www.hackthebox.com" \
-                             "/api/v4/team/info/{}".format(self.htb_team_id)
-            team_stats_link = "https://www.hackthebox.com" \
-                              "/api/v4/team/stats/owns/{}".format(self.htb_team_id)
+            member_activities = member_activities + older_activities
+            oldest_date = datetime.strptime(member_activities[-1].date, date_format)
 
-            headers = {
-                "Authorization": "Bearer " + self.htb_app_token,
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
-                              "Gecko/20100101 Firefox/111.0"
-            }
+        return member_activities
+
+    def get_team_ranking(self):
+        """
+        """
 
-            req = requests.get(team_info_link, headers=headers)
-            team_info_data = json.loads(req.text)
+        self.log.info("Getting team ranking")
 
-            req = requests.get(team_stats_link, headers=headers)
-            team_stats_data = json.loads(req.text)
+        try:
+            team_stats = htb_models.parse_team_stats(
+                self.get_htb_data("/api/v4/team/info/{}".format(self.htb_team_id)),
+                self.get_htb_data("/api/v4/team/stats/owns/{}".format(self.htb_team_id))
+            )
         except Exception as err:
             self.error_handler("Failed to get team ranking data " + str(err), traceback.format_exc())
             return
 
+        # Dry run rankings would be compared with the next week's ranking
+        if self.dry_run:
+            self.log.info("Dry run, team ranking not saved")
+            return
+
         rank_date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        # Ranking interrupted by a restart runs again, keep one ranking per day
+        self.db.delete("team_ranking", "rank_date LIKE '{}%'".format(rank_date[:10]))
         self.db.insert(
             "team_ranking",
             OrderedDict([
                 ("rank_date", rank_date),
-                ("rank", team_stats_data["rank"]),
-                ("points", team_info_data["points"]),
-                ("user_owns", team_stats_data["user_owns"]),
-                ("system_owns", team_stats_data["system_owns"]),
-                ("challenge_owns", team_stats_data["challenge_owns"]),
-                ("respects", team_stats_data["respects"])
+                ("rank", team_stats.rank),
+                ("points", team_stats.points),
+                ("user_owns", team_stats.user_owns),
+                ("system_owns", team_stats.system_owns),
+                ("challenge_owns", team_stats.challenge_owns),
+                ("respects", team_stats.respects)
             ])
         )
 
+    def get_member_progress(self, member_id):
+        """
+        Get ranking data of the member (5 HTB requests). Returns OrderedDict with member_snapshots columns.
+        """
+
+        member_basic = htb_models.parse_profile_basic(
+            self.get_htb_data("/api/v4/user/profile/basic/{}".format(member_id))
+        )
+        challenge_count = htb_models.parse_challenge_owns(
+            self.get_htb_data("/api/v4/user/profile/progress/challenges/{}".format(member_id))
+        )
+        fortress_count = htb_models.parse_owned_flags(
+            self.get_htb_data("/api/v4/user/profile/progress/fortress/{}".format(member_id)),
+            "fortresses"
+        )
+        endgame_count = htb_models.parse_owned_flags(
+            self.get_htb_data("/api/v4/user/profile/progress/endgame/{}".format(member_id)),
+            "endgames"
+        )
+        prolab_count = htb_models.parse_owned_flags(
+            self.get_htb_data("/api/v4/user/profile/progress/prolab/{}".format(member_id)),
+            "prolabs"
+        )
+
+        return OrderedDict([
+            ("rank", member_basic.ranking),
+            ("user_owns", member_basic.user_owns),
+            ("system_owns", member_basic.system_owns),
+            ("challenge_owns", challenge_count),
+            ("fortress_owns", fortress_count),
+            ("endgame_owns", endgame_count),
+            ("prolabs_owns", prolab_count),
+            ("user_bloods", member_basic.user_bloods),
+            ("system_bloods", member_basic.system_bloods),
+            ("respects", member_basic.respects)
+        ])
+
+    def save_member_snapshot(self, member_id):
+        """
+        Get ranking data of the member and save it to member_snapshots (not in dry run). Returns the snapshot
+        or None on failure.
+        """
+
+        try:
+            member_progress = self.get_member_progress(member_id)
+        except Exception as err:
+            self.error_handler("Failed to get member ranking data " + str(err), traceback.format_exc())
+            return None
+
+        if self.dry_run:
+            return member_progress
+
+        self.db.delete("member_snapshots", "id = '{}'".format(member_id))
+        self.db.insert(
+            "member_snapshots",
+            OrderedDict([("id", member_id), ("snapshot_time", time.time())] + list(member_progress.items()))
+        )
+
+        return member_progress
+
+    def collect_member_snapshots(self):
+        """
+        Collect ranking data of a few members every cycle, so the weekly ranking doesn't need to request
+        5 endpoints for every member at once. Members without a snapshot or with the oldest snapshot
+        go first. SNAPSHOTS_PER_CYCLE members are refreshed per cycle and each member at most once
+        every SNAPSHOT_INTERVAL seconds.
+        In the last SNAPSHOT_MAX_AGE seconds before the weekly ranking every member whose snapshot would be
+        too old for the ranking is refreshed, more members per cycle if needed to finish in time.
+        Dry run doesn't save snapshots, so it doesn't collect them.
+        """
+
+        if self.dry_run:
+            self.log.info("Dry run, ranking snapshots are not collected")
+            return
+
+        now = time.time()
+        snapshot_times = {x[0]: x[1] for x in self.db.select("id, snapshot_time", "member_snapshots")}
+        refresh_before = now - self.snapshot_interval
+        ranking_time = self.next_ranking_time()
+        ranking_due_before = ranking_time - self.snapshot_max_age
+        if now >= ranking_due_before:
+            refresh_before = max(refresh_before, ranking_due_before)
+
+        found_member_rows = sorted(
+            [
+                x for x in self.db.select("id, htb_name", "htb_team_members")
+                if self.coordinator.owns_member(x[0]) and snapshot_times.get(x[0], 0) < refresh_before
+            ],
+            key=lambda row: snapshot_times.get(row[0], 0)
+        )
+
+        snapshots_count = self.snapshots_per_cycle
+        if now >= ranking_due_before:
+            # Cycles run every 30 minutes on weekdays
+            cycles_left = max((ranking_time - now) / (60 * 30), 1)
+            snapshots_count = max(snapshots_count, math.ceil(len(found_member_rows) / cycles_left))
+
+        for member_id, member_name in found_member_rows[:snapshots_count]:
+            if self.deadline_exceeded():
+                break
+            self.log.debug("Collecting ranking snapshot for user {} ({})", member_name, member_id)
+            self.save_member_snapshot(member_id)
+
+    def next_ranking_time(self):
+        """
+        Return timestamp of the next weekly ranking (Saturday 01:00).
+        """
+
+        now = datetime.now()
+        ranking_date = (now + timedelta(days=(5 - now.weekday()) % 7)).replace(hour=1, minute=0, second=0,
+                                                                               microsecond=0)
+        # The ranking runs during the whole hour
+        if ranking_date + timedelta(hours=1) <= now:
+            ranking_date += timedelta(days=7)
+
+        return ranking_date.timestamp()
+
     def get_members_ranking(self):
         """
+        Save weekly ranking of each member. Data comes from snapshots collected before the ranking, members
+        without a snapshot newer than SNAPSHOT_MAX_AGE are requested from HTB.
         """
 
         self.log.info("Getting members ranking")
 
+        snapshot_columns = "rank, user_owns, system_owns, challenge_owns, fortress_owns, endgame_owns, " \
+                           "prolabs_owns, user_bloods, system_bloods, respects"
+        snapshots = {}
+        for snapshot_row in self.db.select(
+            "id, " + snapshot_columns,
+            "member_snapshots",
+            "snapshot_time > {}".format(time.time() - self.snapshot_max_age)
+        ):
+            snapshots[snapshot_row[0]] = OrderedDict(zip(snapshot_columns.split(", "), snapshot_row[1:]))
+
         # Get all team members from the database
         found_member_rows = self.db.select("id, htb_name, rank, points, last_flag_date", "htb_team_members")
         for found_member_row in found_member_rows:
@@ -346,75 +927,43 @@ class PWNgress():
             member_points = found_member_row[3]
             member_last_flag_date = found_member_row[4]
 
-            self.log.info("Getting member ranking data for user {} ({})".format(member_name, member_id))
-
-            try:
-                member_basic_link = "https://www.hackthebox.com" \
-                                    "/api/v4/user/profile/basic/{}".format(member_id)
-                member_challenges_link = "https://www.hackthebox.com" \
-                                         "/api/v4/user/profile/progress/challenges/{}".format(member_id)
-                member_fortress_link = "https://www.hackthebox.com" \
-                                       "/api/v4/user/profile/progress/fortress/{}".format(member_id)
-                member_endgame_link = "https://www.hackthebox.com" \
-                                      "/api/v4/user/profile/progress/endgame/{}".format(member_id)
-                member_prolab_link = "https://www.hackthebox.com" \
-                                     "/api/v4/user/profile/progress/prolab/{}".format(member_id)
-                headers = {
-                    "Authorization": "Bearer " + self.htb_app_token,
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
-                                  "Gecko/20100101 Firefox/111.0"
-                }
-
-                req = requests.get(member_basic_link, headers=headers)
-                member_basic_data = json.loads(req.text)
-
-                req = requests.get(member_challenges_link, headers=headers)
-                member_challenges_data = json.loads(req.text)
-
-                req = requests.get(member_fortress_link, headers=headers)
-                member_fortress_data = json.loads(req.text)
-
-                req = requests.get(member_endgame_link, headers=headers)
-                member_endgame_data = json.loads(req.text)
-
-                req = requests.get(member_prolab_link, headers=headers)
-                member_prolab_data = json.loads(req.text)
-
-            except Exception as err:
-                self.error_handler("Failed to get member ranking data " + str(err), traceback.format_exc())
-                return
-
-            fortress_count = 0
-            for member_fortress in member_fortress_data["profile"]["fortresses"]:
-                fortress_count += member_fortress["owned_flags"]
+            # Members without a snapshot take up to 5 requests each, the phase is not stuck
+            self.heartbeat.phase_progress()
+            self.keep_alive()
 
-            endgame_count = 0
-            for member_fortress in member_endgame_data["profile"]["endgames"]:
-                endgame_count += member_fortress["owned_flags"]
+            member_progress = snapshots.get(member_id)
+            if member_progress is None:
+                self.log.info("Getting member ranking data for user {} ({})", member_name, member_id)
+                member_progress = self.save_member_snapshot(member_id)
+                if member_progress is None:
+                    return
 
-            prolab_count = 0
-            for member_fortress in member_prolab_data["profile"]["prolabs"]:
-                prolab_count += member_fortress["owned_flags"]
+            if self.dry_run:
+                continue
 
             rank_date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            # Ranking interrupted by a restart runs again, keep one ranking per day
+            self.db.delete(
+                "member_ranking", "id = '{}' AND rank_date LIKE '{}%'".format(member_id, rank_date[:10])
+            )
             self.db.insert(
                 "member_ranking",
                 OrderedDict([
                     ("id", member_id),
                     ("rank_date", rank_date),
                     ("htb_name", member_name),
-                    ("rank", member_basic_data["profile"]["ranking"]),
+                    ("rank", member_progress["rank"]),
                     ("points", member_points),
-                    ("user_owns", member_basic_data["profile"]["user_owns"]),
-                    ("system_owns", member_basic_data["profile"]["system_owns"]),
-                    ("challenge_owns", member_challenges_data["profile"]["challenge_owns"]["solved"]),
-                    ("fortress_owns", fortress_count),
-                    ("endgame_owns", endgame_count),
-                    ("prolabs_owns", prolab_count),
-                    ("user_bloods", member_basic_data["profile"]["user_bloods"]),
-                    ("system_bloods", member_basic_data["profile"]["system_bloods"]),
+                    ("user_owns", member_progress["user_owns"]),
+                    ("system_owns", member_progress["system_owns"]),
+                    ("challenge_owns", member_progress["challenge_owns"]),
+                    ("fortress_owns", member_progress["fortress_owns"]),
+                    ("endgame_owns", member_progress["endgame_owns"]),
+                    ("prolabs_owns", member_progress["prolabs_owns"]),
+                    ("user_bloods", member_progress["user_bloods"]),
+                    ("system_bloods", member_progress["system_bloods"]),
                     ("last_flag_date", member_last_flag_date),
-                    ("respects", member_basic_data["profile"]["respects"])
+                    ("respects", member_progress["respects"])
                 ])
             )
 
@@ -469,18 +1018,14 @@ class PWNgress():
         #     self.log.error("Failed to send Discord message")
         #     self.log.error(traceback.format_exc())
 
-        # Get 25 team members from the database. We limit it to 25 so ranking image doesn't get too big
+        # Get all team members from the database. The table is split to multiple images (RANKING_PAGE_SIZE)
         found_member_rows = self.db.select(
-            "id",
+            "id, htb_avatar",
             "htb_team_members",
-            "id > 0 ORDER by rank ASC LIMIT 25"
+            "id > 0 ORDER by rank ASC"
         )
-        # Get list of avatar links of the team members
-        avatar_links = [x[0] for x in self.db.select(
-            "htb_avatar",
-            "htb_team_members",
-            "id > 0 ORDER by rank ASC LIMIT 25"
-        )]
+        # List of avatar links of the team members in the table
+        avatar_links = []
         # Ranking table data. Start with headers
         table_data = [["NAME", "RNK", "PNT", "USR", "SYS", "CHL", "FRT", "END", "PRO"]]
         for found_member_row in found_member_rows:
@@ -491,6 +1036,10 @@ class PWNgress():
                 "member_ranking",
                 "id = {} ORDER BY rank_date DESC LIMIT 2".format(member_id)
             )
+            # Member joined after the ranking was saved
+            if not last_two_ranking_data:
+                continue
+            avatar_links.append(found_member_row[1])
             last_two_ranking_data_first = last_two_ranking_data[0]
             # If it's a new member we don't have previous weeks data. Add all user ranking as 0 (no changes)
             if len(last_two_ranking_data) == 1:
@@ -525,23 +1074,139 @@ class PWNgress():
                 # datetime.strftime(datetime.strptime(last_two_ranking_data_first[13], "%Y-%m-%dT%H:%M:%S.%fZ"), "%Y-%m-%d")
             ])
 
-        table_filename = self.create_table_image(table_data, avatar_links)
+        table_filenames = self.create_table_images(table_data, avatar_links)
+
+        # Discord allows 10 attachments per message
+        for message_start in range(0, len(table_filenames), 10):
+            table_files = [
+                open(table_filename, "rb") for table_filename in table_filenames[message_start:message_start + 10]
+            ]
+            try:
+                image_files = {
+                    "PWN{}".format(i): (os.path.basename(table_file.name), table_file)
+                    for i, table_file in enumerate(table_files)
+                }
+                req = self.post_webhook(self.discord_webhook_url_team, files=image_files)
+            except Exception as err:
+                self.error_handler("Failed to send Discord message " + str(err), traceback.format_exc())
+            finally:
+                for table_file in table_files:
+                    table_file.close()
+
+    def create_table_images(self, table_data, avatar_links):
+        """
+        Create ranking table images encoded with IMAGE_FORMAT, RANKING_PAGE_SIZE members per image.
+        Column widths are calculated once, so all pages look like one table. Pages are rendered in
+        parallel. Returns list of filenames.
+        """
+
+        from utils.image_encoding import save_image
+
+        header_row = table_data[0]
+        member_rows = table_data[1:]
+        col_max_wid, _ = self.get_table_layout(table_data, self.get_table_fonts())
+        avatar_images = self.fetch_avatar_images(avatar_links)
+
+        def create_table_page(page_index):
+            page_start = page_index * self.ranking_page_size
+            page_end = page_start + self.ranking_page_size
+            tab = self.render_table_image(
+                [header_row] + member_rows[page_start:page_end],
+                avatar_images[page_start:page_end],
+                col_max_wid
+            )
+            table_filename = save_image(tab, "/tmp/PWNrank-{}".format(page_index + 1), self.image_format)
+            tab.close()
+            return table_filename
+
+        page_count = max((len(member_rows) + self.ranking_page_size - 1) // self.ranking_page_size, 1)
+        table_filenames = list(self.get_render_executor().map(create_table_page, range(page_count)))
+
+        for htb_avatar_image in avatar_images:
+            if htb_avatar_image is not None:
+                htb_avatar_image.close()
+
+        return table_filenames
+
+    def get_render_executor(self):
+        """
+        Thread pool for avatar downloads and ranking pages. Created on first use and kept, so the weekly
+        ranking doesn't start new threads (and new malloc arenas) every time.
+        """
+
+        if self.render_executor is None:
+            self.render_executor = ThreadPoolExecutor(max_workers=self.render_workers)
 
-        image_file = {
-            "PWN": open(table_filename, "rb")
+        return self.render_executor
+
+    def get_table_fonts(self):
+        """
+        Load ranking table fonts. Fonts are loaded per rendered page, so pages can be rendered in parallel.
+        """
+
+        from PIL import ImageFont
+
+        return {
+            "header": ImageFont.truetype(self.font_table_header, size=26, layout_engine=0),
+            "names": ImageFont.truetype(self.font_table_names, size=28, layout_engine=0),
+            "data": ImageFont.truetype(self.font_table_data, size=22, layout_engine=0)
         }
 
-        try:
-            req = requests.post(self.discord_webhook_url_team, files=image_file)
-        except Exception as err:
-            self.error_handler("Failed to send Discord message " + str(err), traceback.format_exc())
+    def get_table_layout(self, table_data, table_fonts):
+        """
+        Calculate column widths and row heights of the ranking table. Returns (col_max_wid, row_max_hei).
+        """
+
+        row_max_hei = [0] * len(table_data)
+        col_max_wid = [0] * len(max(table_data, key=len))
+
+        for i in range(len(table_data)):
+            for j in range(len(table_data[i])):
+                # Header font
+                if i == 0:
+                    font = table_fonts["header"]
+                    row_max_hei[i] = max(round(font.getbbox(table_data[i][j])[3]) + 5, row_max_hei[i])
+                else:
+                    if j == 0:
+                        # Names font
+                        font = table_fonts["names"]
+                        # Add spacing to data cell to add up/down arrows if needed
+                        col_max_wid[j] = max(round(font.getlength(table_data[i][j])) + 33, col_max_wid[j])
+                    else:
+                        # Data font
+                        font = table_fonts["data"]
+                        col_max_wid[j] = max(round(font.getlength(table_data[i][j])) + 30, col_max_wid[j])
+                    row_max_hei[i] = max(round(font.getbbox(table_data[i][j])[3]), row_max_hei[i])
+
+        return col_max_wid, row_max_hei
 
-    def create_table_image(self, table_data, avatar_links):
+    def fetch_avatar_images(self, avatar_links):
         """
-        Create ranking table image. Based on https://gist.github.com/xiaopc/324acb627e6f1f019ab60b0ec0e355aa
+        Download avatars for the ranking table in parallel. Returns list of 25x25 images (None if the avatar
+        couldn't be downloaded) in the same order as avatar_links.
         """
 
-        table_filename = "/tmp/PWNrank.png"
+        def fetch_avatar_image(avatar_link):
+            try:
+                htb_avatar_image = self.fetch_image(avatar_link)
+            except Exception as err:
+                self.error_handler("Failed to get member image " + str(err), traceback.format_exc())
+                return None
+            htb_avatar_image.thumbnail((25, 25))
+            return htb_avatar_image
+
+        return list(self.get_render_executor().map(fetch_avatar_image, avatar_links))
+
+    def render_table_image(self, table_data, avatar_images, col_max_wid=None):
+        """
+        Render ranking table image. Based on https://gist.github.com/xiaopc/324acb627e6f1f019ab60b0ec0e355aa
+        avatar_images - avatars of the members in table_data rows (None leaves the cell empty).
+        col_max_wid - column widths, calculated from table_data if not set.
+        """
+
+        # Pillow is imported only when rendering, so CLI phases without images start faster
+        from PIL import Image, ImageDraw
+
         colors = {
             "background": (43, 45, 49),
             "header_background": (38, 38, 38),
@@ -565,26 +1230,11 @@ class PWNgress():
         }
         margin = 5
 
-        row_max_hei = [0] * len(table_data)
-        col_max_wid = [0] * len(max(table_data, key=len))
-
-        for i in range(len(table_data)):
-            for j in range(len(table_data[i])):
-                # Header font
-                if i == 0:
-                    font = ImageFont.truetype(self.font_table_header, size=26, layout_engine=0)
-                    row_max_hei[i] = max(round(font.getbbox(table_data[i][j])[3]) + 5, row_max_hei[i])
-                else:
-                    if j == 0:
-                        # Names font
-                        font = ImageFont.truetype(self.font_table_names, size=28, layout_engine=0)
-                        # Add spacing to data cell to add up/down arrows if needed
-                        col_max_wid[j] = max(round(font.getlength(table_data[i][j])) + 33, col_max_wid[j])
-                    else:
-                        # Data font
-                        font = ImageFont.truetype(self.font_table_data, size=22, layout_engine=0)
-                        col_max_wid[j] = max(round(font.getlength(table_data[i][j])) + 30, col_max_wid[j])
-                    row_max_hei[i] = max(round(font.getbbox(table_data[i][j])[3]), row_max_hei[i])
+        table_fonts = self.get_table_fonts()
+        table_col_max_wid, row_max_hei = self.get_table_layout(table_data, table_fonts)
+        # Pages of one ranking use column widths calculated over all pages
+        if col_max_wid is None:
+            col_max_wid = table_col_max_wid
 
         tab_width = sum(col_max_wid) + len(col_max_wid) * 2 * margin
         tab_heigh = sum(row_max_hei) + len(row_max_hei) * 2 * margin
@@ -622,19 +1272,27 @@ class PWNgress():
             left += col_w + margin * 2
         draw.line([(left, margin), (left, tab_heigh + margin)], fill=colors["line"])
 
+        # Up/down arrows on the table background, loaded once per table
+        arrow_images = {}
+        for arrow_name in ["up", "down"]:
+            with Image.open(os.path.join(self.images_dir, "arrow_{}.png".format(arrow_name))) as arrow_image:
+                arrow_images[arrow_name] = Image.new("RGBA", arrow_image.size, colors["background"])
+                arrow_images[arrow_name].paste(arrow_image, (0, 0), arrow_image)
+                arrow_images[arrow_name].thumbnail((25, 25))
+
         top, left = margin + margin, 0
         for i in range(len(table_data)):
             left = margin + margin
             for j in range(len(table_data[i])):
                 if i == 0:
                     color = colors["header_colors"][j]
-                    font = ImageFont.truetype(self.font_table_header, size=26, layout_engine=0)
+                    font = table_fonts["header"]
                 else:
                     if j == 0:
-                        font = ImageFont.truetype(self.font_table_names, size=28, layout_engine=0)
+                        font = table_fonts["names"]
                         color = colors["names"]
                     else:
-                        font = ImageFont.truetype(self.font_table_data, size=22, layout_engine=0)
+                        font = table_fonts["data"]
                         color = colors["data"]
                 if "-" in table_data[i][j]:
                     if j == 1:
@@ -662,67 +1320,82 @@ class PWNgress():
                     else:
                         if "-" in table_data[i][j]:
                             if j == 1:
-                                with open("../images/arrow_up.png", "rb") as f:
-                                    arrow_image = Image.open(io.BytesIO(f.read()))
+                                tab.paste(arrow_images["up"], (_left - 28, top - 1))
                             else:
-                                with open("../images/arrow_down.png", "rb") as f:
-                                    arrow_image = Image.open(io.BytesIO(f.read()))
-                            new_arrow_image = Image.new("RGBA", arrow_image.size, colors["background"])
-                            new_arrow_image.paste(arrow_image, (0, 0), arrow_image)
-                            new_arrow_image.thumbnail((25, 25))
-                            tab.paste(new_arrow_image, (_left - 28, top - 1))
+                                tab.paste(arrow_images["down"], (_left - 28, top - 1))
                         elif "+" in table_data[i][j]:
                             if j == 1:
-                                with open("../images/arrow_down.png", "rb") as f:
-                                    arrow_image = Image.open(io.BytesIO(f.read()))
+                                tab.paste(arrow_images["down"], (_left - 28, top - 1))
                             else:
-                                with open("../images/arrow_up.png", "rb") as f:
-                                    arrow_image = Image.open(io.BytesIO(f.read()))
-                            new_arrow_image = Image.new("RGBA", arrow_image.size, colors["background"])
-                            new_arrow_image.paste(arrow_image, (0, 0), arrow_image)
-                            new_arrow_image.thumbnail((25, 25))
-                            tab.paste(new_arrow_image, (_left - 28, top - 1))
+                                tab.paste(arrow_images["up"], (_left - 28, top - 1))
                         draw.text((_left, top), table_data[i][j], font=font, fill=color)
                 left += col_max_wid[j] + margin * 2
             top += row_max_hei[i] + margin * 2
 
-        # HTTP headers for image downloading
+        # Avatars go to the name cells, next to the member name
+        top = margin + row_max_hei[0] + margin * 2
+        for i, htb_avatar_image in enumerate(avatar_images, start=1):
+            if htb_avatar_image is not None:
+                tab.paste(htb_avatar_image, (10, top + margin))
+            top += row_max_hei[i] + margin * 2
+
+        for arrow_image in arrow_images.values():
+            arrow_image.close()
+
+        # tab.show()
+
+        return tab
+
+    def fetch_image(self, image_url):
+        """
+        Download image and return it as PIL image.
+        """
+
+        from PIL import Image
+
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
                           "Gecko/20100101 Firefox/111.0"
         }
-        indent = 0
 
-        for avatar_link in avatar_links:
-            # Download HTB user image
-            try:
-                req = requests.get(avatar_link, headers=headers)
-            except Exception as err:
-                self.error_handler("Failed to get member image " + str(err), traceback.format_exc())
+        req = requests.get(image_url, headers=headers, timeout=self.request_timeout)
 
-            htb_avatar_image = Image.open(io.BytesIO(req.content))
+        return Image.open(io.BytesIO(req.content))
 
-            # filename = avatar_link.split("/")[-1:][0]
-            # with open("/tmp/" + filename, "rb") as f:
-            #     htb_avatar_image = Image.open(io.BytesIO(f.read()))
-            #     f.write(req.content)
+    def create_image(self, htb_name, htb_user_avatar_url, htb_flag_type, message):
+        """
+        Create notification image file encoded with IMAGE_FORMAT. Returns filename or False on failure.
+        """
 
-            htb_avatar_image.thumbnail((25, 25))
-            tab.paste(htb_avatar_image, (10, 49 + indent))
-            indent += 31
+        # Final image filename
+        tmp_htb_name = re.sub('[^a-zA-Z0-9]+', '', htb_name).upper()
+        tmp_message_1 = re.sub('[^a-zA-Z0-9]+', '', message[1]).upper()
+        tmp_message_2 = re.sub('[^a-zA-Z0-9]+', '', message[2]).replace("machine", "").replace("challenge", "").upper()
 
-        # tab.show()
-        tab.save(table_filename)
+        from utils.image_encoding import save_image
 
-        return table_filename
+        background_layer = self.render_notification_image(htb_name, htb_user_avatar_url, htb_flag_type, message)
+        if not background_layer:
+            return False
 
-    def create_image(self, htb_name, htb_user_avatar_url, htb_flag_type, message):
+        notification_filename = save_image(
+            background_layer,
+            "/tmp/{}-{}-{}".format(tmp_htb_name, tmp_message_1, tmp_message_2),
+            self.image_format
+        )
+        background_layer.close()
+
+        return notification_filename
+
+    def render_notification_image(self, htb_name, htb_user_avatar_url, htb_flag_type, message):
         """
-        Create notification image. The image will consist of HTB user avatar, frame layers over the avatar,
+        Render notification image. The image will consist of HTB user avatar, frame layers over the avatar,
         message describing flag obtained and image of the Flag.
         htb_flag_type - parameters is URL of the machine or type of the challenge.
         """
 
+        from PIL import Image, ImageDraw, ImageFont
+
         # Size of notification image
         width = 500
         height = 110
@@ -730,12 +1403,6 @@ class PWNgress():
         flag_size = 80
         margin_size = 15
 
-        # Final image filename
-        tmp_htb_name = re.sub('[^a-zA-Z0-9]+', '', htb_name).upper()
-        tmp_message_1 = re.sub('[^a-zA-Z0-9]+', '', message[1]).upper()
-        tmp_message_2 = re.sub('[^a-zA-Z0-9]+', '', message[2]).replace("machine", "").replace("challenge", "").upper()
-        notification_filename = "/tmp/{}-{}-{}.png".format(tmp_htb_name, tmp_message_1, tmp_message_2)
-
         # Colors used in the notification
         background_color = (43, 45, 49)
         white_color = (255, 255, 255)
@@ -745,50 +1412,47 @@ class PWNgress():
         fortress_color = (148, 0, 255)
         challenge_color = (159, 239, 0)
 
-        # HTTP headers for image downloading
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0)"
-                          "Gecko/20100101 Firefox/111.0"
-        }
-
         # Create main surface for the notification
         background_layer = Image.new(mode="RGB", size=(width, height), color=background_color)
 
         # Download HTB user image
         try:
-            req = requests.get(htb_user_avatar_url, headers=headers)
+            discord_image = self.fetch_image(htb_user_avatar_url)
         except Exception as err:
             self.error_handler("Failed to get member image " + str(err), traceback.format_exc())
             return False
 
         # Create Discord image
-        discord_image = Image.open(io.BytesIO(req.content))
         discord_image.thumbnail((avatar_size, avatar_size))
         background_layer.paste(discord_image, (margin_size, margin_size))
+        discord_image.close()
 
         # Create flag/machine image
-        if "hackthebox" in htb_flag_type:
+        if htb_flag_type.startswith("http"):
             # If it's a machine flag we are passing URL and we need to download the image
             try:
-                req = requests.get(htb_flag_type, headers=headers)
-                machine_img = Image.open(io.BytesIO(req.content))
+                machine_img = self.fetch_image(htb_flag_type)
             except Exception as err:
                 self.error_handler("Failed to get machine image " + str(err), traceback.format_exc())
                 return False
         else:
             # If it's challenge, endgame or fortress flag we use local image
-            machine_img = Image.open("../images/{}.png".format(htb_flag_type.lower()))
+            machine_img = Image.open(os.path.join(self.images_dir, "{}.png".format(htb_flag_type.lower())))
 
         new_machine_img = Image.new("RGBA", machine_img.size, background_color)
         new_machine_img.paste(machine_img, (0, 0), machine_img)
         new_machine_img.thumbnail((flag_size, flag_size))
         background_layer.paste(new_machine_img, (width - flag_size - margin_size, margin_size), new_machine_img)
+        machine_img.close()
+        new_machine_img.close()
 
         # Frame image
-        frame_img = Image.open("../images/avatar_frame.png").convert("RGBA")
-        img_thumb = frame_img.copy()
-        img = img_thumb.resize((height, height))
+        with Image.open(os.path.join(self.images_dir, "avatar_frame.png")) as frame_file:
+            frame_img = frame_file.convert("RGBA")
+        img = frame_img.resize((height, height))
         background_layer.paste(img, (0, 0), img)
+        frame_img.close()
+        img.close()
 
         # Message text
         image_editable = ImageDraw.Draw(background_layer)
@@ -810,17 +1474,22 @@ class PWNgress():
                 font_htb_name_size -= 1
 
         font_message = ImageFont.truetype(self.font_message, size=18, layout_engine=0)
-        if message[1] == "ROOT " or message[1] == "USER ":
-            # Machine message
+        if message[1] in ["ROOT ", "USER ", "USER + ROOT ", "ROOT + USER "]:
+            # Machine message, coalesced solves have both flags ("USER + ROOT ")
             x_pos_1 = width // 2 - font_message.getlength("".join(message)) // 2 + 5
             x_pos_2 = x_pos_1 + font_message.getlength(message[0])
             x_pos_3 = x_pos_2 + font_message.getlength(message[1])
 
             image_editable.text((x_pos_1, 70), message[0], fill=white_color, font=font_message)
-            if message[1] == "ROOT ":
-                image_editable.text((x_pos_2, 70), message[1], fill=red_color, font=font_message)
-            else:
-                image_editable.text((x_pos_2, 70), message[1], fill=green_color, font=font_message)
+            for flag_index, flag_name in enumerate(message[1].split(" + ")):
+                if flag_index:
+                    image_editable.text((x_pos_2, 70), " + ", fill=white_color, font=font_message)
+                    x_pos_2 += font_message.getlength(" + ")
+                if flag_name.strip() == "ROOT":
+                    image_editable.text((x_pos_2, 70), flag_name, fill=red_color, font=font_message)
+                else:
+                    image_editable.text((x_pos_2, 70), flag_name, fill=green_color, font=font_message)
+                x_pos_2 += font_message.getlength(flag_name)
             image_editable.text((x_pos_3, 70), message[2], fill=white_color, font=font_message)
         else:
             # Challenge, endgame or fortress message
@@ -838,82 +1507,355 @@ class PWNgress():
                 image_editable.text((x_pos_2, 65), message[1], fill=fortress_color, font=font_message)
             elif "challenge" in message[2]:
                 image_editable.text((x_pos_2, 65), message[1], fill=challenge_color, font=font_message)
+            else:
+                image_editable.text((x_pos_2, 65), message[1], fill=white_color, font=font_message)
             image_editable.text((x_pos_3, 80), message[2], fill=white_color, font=font_message)
 
         # background_layer.show()
 
-        # Save image as a file and return
-        background_layer.save(notification_filename)
-
-        return notification_filename
+        return background_layer
 
     def send_member_solves_messages(self):
         """
-        Sort saved messages and send them.
-        """
-
-        self.log.info("Message queue - " + str(len(self.message_queue)))
-
-        if self.message_queue:
-            sorted_message_queue = OrderedDict(sorted(self.message_queue.items()))
-            for _, message_data in sorted_message_queue.items():
-                if self.send_message(
-                    message_data["member_id"],
-                    message_data["member_name"],
-                    message_data["activity_data"]
-                ):
-                    self.db.update(
-                        "htb_team_members",
-                        OrderedDict([
-                            ("last_flag_date", message_data["activity_data"]["date"])
-                        ]),
-                        "id = '{}'".format(message_data["member_id"])
-                    )
+        Sort saved messages and send them. Solves of the same member within COALESCE_WINDOW are sent as one
+        combined message.
+        """
+
+        # With multiple replicas only the leader sends messages found by all replicas
+        if self.dry_run:
+            message_queue = self.message_queue
+        else:
+            message_queue = self.coordinator.share_messages(self.message_queue, self.max_queue_size)
+
+        self.log.info("Message queue - {}", len(message_queue))
+        self.update_embed_mode(message_queue)
+
+        if message_queue:
+            sorted_message_queue = OrderedDict(sorted(message_queue.items()))
+            solve_groups = self.coalesce_solves(sorted_message_queue)
+
+            sent_groups = []
+            if self.catchup_gap and len(sorted_message_queue) > self.catchup_digest_threshold:
+                # Too many missed solves for separate messages
+                if self.send_catchup_digest(solve_groups):
+                    sent_groups = solve_groups
+            elif self.embed_mode:
+                sent_groups = self.send_embed_messages(solve_groups)
+            else:
+                for group_index, solve_group in enumerate(solve_groups):
+                    # After downtime send missed solves in batches, so the webhook is not rate limited
+                    if self.catchup_gap and group_index and group_index % self.catchup_batch_size == 0:
+                        time.sleep(self.catchup_batch_delay)
+
+                    member_id = solve_group[0][1]["member_id"]
+                    activities = [message_data["activity_data"] for queue_key, message_data in solve_group]
+                    if self.send_message(member_id, solve_group[0][1]["member_name"], activities):
+                        sent_groups.append(solve_group)
+
+            # Dry run leaves the solves to be notified by the next real run
+            delivered_keys = []
+            for solve_group in sent_groups:
+                if self.dry_run:
+                    break
+                self.db.update(
+                    "htb_team_members",
+                    OrderedDict([
+                        ("last_flag_date", solve_group[-1][1]["activity_data"].date)
+                    ]),
+                    "id = '{}'".format(solve_group[0][1]["member_id"])
+                )
+                delivered_keys.extend(queue_key for queue_key, message_data in solve_group)
+                for queue_key, message_data in solve_group:
+                    self.save_member_solve(message_data["member_id"], message_data["member_name"],
+                                           message_data["activity_data"])
+            self.coordinator.mark_delivered(delivered_keys)
+
+        # Team polling mode has to look further back for members whose solves were not sent
+        undelivered_member_ids = {
+            message_data["member_id"] for queue_key, message_data in message_queue.items()
+            if queue_key not in delivered_keys
+        } if message_queue else set()
+        self.set_state("undelivered_member_ids", ",".join(str(x) for x in sorted(undelivered_member_ids)))
+
+        # Forget delivered solves and solves that are not found anymore
+        if message_queue and not self.dry_run:
+            for queue_key in delivered_keys:
+                self.first_queued_times.pop(queue_key, None)
+        self.first_queued_times = {
+            queue_key: queued_at for queue_key, queued_at in self.first_queued_times.items()
+            if queued_at > time.time() - 24 * 3600
+        }
 
         # Always empty message queue
         self.message_queue = {}
 
-    def send_message(self, member_id, htb_name, activity_data):
+    def save_member_solve(self, member_id, member_name, activity_data):
         """
-        Send message in Discord using Webhook.
+        Save notified solve to member_solves (latest solves in the stats API).
         """
 
-        self.log.info("        Sending message for user {} ({})".format(htb_name, member_id))
+        self.db.insert(
+            "member_solves",
+            OrderedDict([
+                ("member_id", member_id),
+                ("member_name", member_name),
+                ("solve_date", activity_data.date),
+                ("object_type", activity_data.object_type),
+                ("type", activity_data.type),
+                ("name", activity_data.name),
+                ("challenge_category", activity_data.challenge_category),
+                ("flag_title", activity_data.flag_title)
+            ])
+        )
+
+    def update_embed_mode(self, message_queue):
+        """
+        Switch to embed mode when the queue has EMBED_MODE_QUEUE_SIZE messages or the oldest message waits
+        EMBED_MODE_AGE seconds. Rendered images are used again when the queue drops under half of both
+        thresholds, so the mode doesn't change with every cycle.
+        """
+
+        queue_age = time.time() - min(x["queued_at"] for x in message_queue.values()) if message_queue else 0
+        over_size = self.embed_mode_queue_size and len(message_queue) >= self.embed_mode_queue_size
+        over_age = self.embed_mode_age and queue_age >= self.embed_mode_age
+        under_half = (not self.embed_mode_queue_size or len(message_queue) < self.embed_mode_queue_size / 2) and \
+            (not self.embed_mode_age or queue_age < self.embed_mode_age / 2)
+
+        if not self.embed_mode and (over_size or over_age):
+            self.embed_mode = True
+            self.log.warning(
+                "Switching to embed mode, {} messages queued, oldest waiting {:.0f} sec", len(message_queue), queue_age
+            )
+        elif self.embed_mode and under_half:
+            self.embed_mode = False
+            self.log.info("Switching back to notification images, {} messages queued", len(message_queue))
+
+    def get_solve_embed(self, member_id, htb_name, activities):
+        """
+        Return Discord embed describing solves of one member. Images are referenced by their HTB URLs
+        (member avatar and machine avatar), nothing is rendered.
+        """
 
         htb_user_avatar_url = self.db.select("htb_avatar", "htb_team_members", f"id = '{member_id}'")[0][0]
 
+        text = ""
+        if len(activities) == 1:
+            message, htb_flag_type = self.get_solve_message(activities[0])
+        else:
+            message, htb_flag_type, text = self.get_coalesced_message(activities)
+
+        # Same colors as the notification image
+        embed_colors = {
+            "user": 0x86BE3C,
+            "root": 0xFF0000,
+            "challenge": 0x9FEF00,
+            "fortress": 0x9400FF,
+            "endgame": 0x0086FF
+        }
+        if activities[-1].object_type == "machine":
+            embed_color = embed_colors[activities[-1].type]
+        else:
+            embed_color = embed_colors.get(activities[-1].object_type, 0xFFFFFF)
+
+        solve_embed = {
+            "author": {
+                "name": htb_name,
+                "icon_url": htb_user_avatar_url
+            },
+            "description": text or " ".join(part.strip() for part in message),
+            "color": embed_color,
+            "timestamp": activities[-1].date
+        }
+        # Machine avatar, challenges, fortresses and endgames only have local images
+        if htb_flag_type.startswith("http"):
+            solve_embed["thumbnail"] = {
+                "url": htb_flag_type
+            }
+
+        return solve_embed
+
+    def send_embed_messages(self, solve_groups):
+        """
+        Send solves as Discord embeds, 10 (Discord limit) in one message. Returns list of sent solve groups.
+        """
+
+        self.log.info("Sending {} solves as embeds", len(solve_groups))
+
+        sent_groups = []
+        for batch_start in range(0, len(solve_groups), 10):
+            batch_groups = solve_groups[batch_start:batch_start + 10]
+            try:
+                solve_embeds = [
+                    self.get_solve_embed(
+                        solve_group[0][1]["member_id"],
+                        solve_group[0][1]["member_name"],
+                        [message_data["activity_data"] for queue_key, message_data in solve_group]
+                    )
+                    for solve_group in batch_groups
+                ]
+                req = self.post_webhook(self.discord_webhook_url_team, json={"embeds": solve_embeds})
+            except Exception as err:
+                self.error_handler("Failed to send Discord embeds " + str(err), traceback.format_exc())
+                break
+            sent_groups.extend(batch_groups)
+
+        return sent_groups
+
+    def send_catchup_digest(self, solve_groups):
+        """
+        Send solves missed during downtime as one text summary instead of a notification image per solve.
+        The summary is split into several messages if it's longer than the Discord limit (2000 characters).
+        Returns True if everything was sent.
+        """
+
+        solves_count = sum(len(solve_group) for solve_group in solve_groups)
+        self.log.info("Sending catch-up summary of {} solves", solves_count)
+
+        digest_lines = ["**Solves missed while PWNgress was offline ({:.1f} h): {}**".format(
+            self.catchup_gap / 3600, solves_count
+        )]
+        for solve_group in solve_groups:
+            for queue_key, message_data in solve_group:
+                message, htb_flag_type = self.get_solve_message(message_data["activity_data"])
+                digest_lines.append("{} - {}".format(
+                    message_data["member_name"], " ".join(part.strip() for part in message)
+                ))
+
+        digest_messages = [""]
+        for digest_line in digest_lines:
+            if len(digest_messages[-1]) + len(digest_line) + 1 > 2000:
+                digest_messages.append("")
+            digest_messages[-1] += digest_line + "\n"
+
+        for digest_message in digest_messages:
+            try:
+                req = self.post_webhook(self.discord_webhook_url_team, json={"content": digest_message})
+            except Exception as err:
+                self.error_handler("Failed to send catch-up summary " + str(err), traceback.format_exc())
+                return False
+
+        return True
+
+    def coalesce_solves(self, sorted_message_queue):
+        """
+        Group sorted messages by member. A solve joins the member's group if it happened at most
+        coalesce_window seconds after the first solve of the group. Returns list of groups
+        [(queue_key, message_data), ...] ordered by the first solve, solves in a group are ordered by date.
+        """
+
+        solve_groups = []
+        open_groups = {}
+        for queue_key, message_data in sorted_message_queue.items():
+            # Queue key is "{solve timestamp}_{member_id}"
+            solve_time = float(queue_key.split("_")[0])
+            member_group = open_groups.get(message_data["member_id"])
+            if member_group and solve_time - member_group[0] < self.coalesce_window:
+                member_group[1].append((queue_key, message_data))
+                continue
+
+            member_group = (solve_time, [(queue_key, message_data)])
+            open_groups[message_data["member_id"]] = member_group
+            solve_groups.append(member_group[1])
+
+        return solve_groups
+
+    def get_solve_message(self, activity_data):
+        """
+        Return (message, htb_flag_type) describing a single solve.
+        """
+
         # Create different messages for different type of solves and assign flag type (machine/challenge)
         message = ""
         htb_flag_type = ""
-        if activity_data["object_type"] == "machine":
+        if activity_data.object_type == "machine":
             message = [
                 "Owned ",
-                activity_data["type"].upper() + " ",
-                activity_data["name"] + " " + activity_data["object_type"]
+                activity_data.type.upper() + " ",
+                activity_data.name + " " + activity_data.object_type
             ]
-            htb_flag_type = "https://www.hackthebox.com" + activity_data["machine_avatar"].replace("_thumb", "")
-        elif activity_data["object_type"] == "challenge":
+            htb_flag_type = htb_models.HTB_URL + activity_data.machine_avatar.replace("_thumb", "")
+        elif activity_data.object_type == "challenge":
             message = [
                 "Owned ",
-                activity_data["name"],
-                activity_data["challenge_category"] + " " + activity_data["object_type"]
+                activity_data.name,
+                activity_data.challenge_category + " " + activity_data.object_type
             ]
-            htb_flag_type = activity_data["challenge_category"]
-        elif activity_data["object_type"] == "fortress":
+            htb_flag_type = activity_data.challenge_category
+        elif activity_data.object_type == "fortress":
             message = [
                 "Owned ",
-                activity_data["flag_title"],
+                activity_data.flag_title,
                 # Shorten name for Context fortress
-                activity_data["name"].replace("Cyber Attack Simulation", "") + " " + activity_data["object_type"]
+                activity_data.name.replace("Cyber Attack Simulation", "") + " " + activity_data.object_type
             ]
-            htb_flag_type = activity_data["object_type"]
-        elif activity_data["object_type"] == "endgame":
+            htb_flag_type = activity_data.object_type
+        elif activity_data.object_type == "endgame":
             message = [
                 "Owned ",
-                activity_data["flag_title"],
-                activity_data["name"] + " " + activity_data["object_type"]
+                activity_data.flag_title,
+                activity_data.name + " " + activity_data.object_type
             ]
-            htb_flag_type = activity_data["object_type"]
+            htb_flag_type = activity_data.object_type
+
+        return message, htb_flag_type
+
+    def get_coalesced_message(self, activities):
+        """
+        Return (message, htb_flag_type, text) for several solves of one member. USER and ROOT of one machine
+        are merged into "Owned USER + ROOT Lame machine". Other solves are listed on the image and the full
+        list is sent as message text, so nothing is lost when the image text has to be shortened.
+        """
+
+        solve_messages = [self.get_solve_message(activity_data) for activity_data in activities]
+        message, htb_flag_type = solve_messages[0]
+        text = ""
+
+        if all(x.object_type == "machine" and x.name == activities[0].name for x in activities):
+            flag_names = []
+            for activity_data in activities:
+                if activity_data.type.upper() not in flag_names:
+                    flag_names.append(activity_data.type.upper())
+            return [message[0], " + ".join(flag_names) + " ", message[2]], htb_flag_type, text
+
+        object_types = []
+        for activity_data in activities:
+            if activity_data.object_type not in object_types:
+                object_types.append(activity_data.object_type)
+        if len(object_types) == 1:
+            target_description = "{} {}".format(
+                len(activities), object_types[0] + ("es" if object_types[0].endswith("s") else "s")
+            )
+        else:
+            target_description = " + ".join(object_types)
+
+        # Flag of the machine is USER/ROOT, of other targets the challenge name or the flag title
+        flag_names = [
+            (x[0][1] + activity_data.name) if activity_data.object_type == "machine" else x[0][1]
+            for x, activity_data in zip(solve_messages, activities)
+        ]
+        message = [message[0], " + ".join(flag_names), target_description]
+        text = "\n".join(" ".join(part.strip() for part in x[0]) for x in solve_messages)
+
+        # Shorten long flag lists so they fit on the image
+        if len(message[1]) > 30:
+            message[1] = message[1][:27] + "..."
+
+        return message, htb_flag_type, text
+
+    def send_message(self, member_id, htb_name, activities):
+        """
+        Send message in Discord using Webhook. activities - list of solves (Activity) sent as one message.
+        """
+
+        self.log.info("        Sending message for user {} ({}), {} solves", htb_name, member_id, len(activities))
+
+        htb_user_avatar_url = self.db.select("htb_avatar", "htb_team_members", f"id = '{member_id}'")[0][0]
+
+        text = ""
+        if len(activities) == 1:
+            message, htb_flag_type = self.get_solve_message(activities[0])
+        else:
+            message, htb_flag_type, text = self.get_coalesced_message(activities)
 
         # Create notification image
         try:
@@ -925,27 +1867,101 @@ class PWNgress():
 
         # Send image to Discord
         if notification_filename:
-            image_file = {
-                "PWN": open(notification_filename, "rb")
-            }
-
             try:
-                req = requests.post(self.discord_webhook_url_team, files=image_file)
+                with open(notification_filename, "rb") as notification_file:
+                    image_file = {
+                        "PWN": notification_file
+                    }
+                    if text:
+                        req = self.post_webhook(self.discord_webhook_url_team, data={"content": text}, files=image_file)
+                    else:
+                        req = self.post_webhook(self.discord_webhook_url_team, files=image_file)
             except Exception as err:
                 self.error_handler("Failed to send Discord message " + str(err), traceback.format_exc())
                 os.remove(notification_filename)
                 return False
 
-            os.remove(notification_filename)
+            # Keep the image for inspection in dry run
+            if self.dry_run:
+                self.log.info("Dry run, notification image saved as {}", notification_filename)
+            else:
+                os.remove(notification_filename)
 
         return True
 
 def main():
+    """
+    Command line interface. Without a command the bot runs forever (Docker). Other commands run one phase
+    or one cycle and exit, so PWNgress can be driven by cron or another job scheduler.
+    """
+
+    parser = argparse.ArgumentParser(description="HTB team progress Discord bot")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Don't send Discord messages and don't save notification state, rankings, ranking "
+                             "snapshots, bot state or replica coordination")
+    parser.add_argument("command", nargs="?", default="run",
+                        choices=["run", "cycle", "sync", "poll", "snapshots", "ranking"],
+                        help="run - loop forever (default), cycle - one full cycle, sync - update team members, "
+                             "poll - check and send new solves, snapshots - collect ranking snapshots, "
+                             "ranking - save and send the weekly ranking now")
+    args = parser.parse_args()
+
     settings = read_settings_file("settings/PWNgress_settings.cfg")
-    PWNgress(settings["HTB_APP_TOKEN"], settings["HTB_TEAM_ID"], settings["DISCORD_WEBHOOK_URL_TEAM"],
-             settings["DISCORD_WEBHOOK_URL_ALERTS"], settings["FONT_HTB_NAME"], settings["FONT_MESSAGE"],
-             settings["HTB_USERS_TO_IGNORE"], settings["FONT_TABLE_HEADER"], settings["FONT_TABLE_NAMES"],
-             settings["FONT_TABLE_DATA"])
+    pwngress = PWNgress(settings["HTB_APP_TOKEN"], settings["HTB_TEAM_ID"], settings["DISCORD_WEBHOOK_URL_TEAM"],
+                        settings["DISCORD_WEBHOOK_URL_ALERTS"], settings["FONT_HTB_NAME"], settings["FONT_MESSAGE"],
+                        settings["HTB_USERS_TO_IGNORE"], settings["FONT_TABLE_HEADER"], settings["FONT_TABLE_NAMES"],
+                        settings["FONT_TABLE_DATA"],
+                        connect_timeout=settings.get("CONNECT_TIMEOUT", 5),
+                        read_timeout=settings.get("READ_TIMEOUT", 30),
+                        cycle_deadline=settings.get("CYCLE_DEADLINE", 600),
+                        coordinator_type=settings.get("COORDINATOR", "local"),
+                        replica_id=settings.get("REPLICA_ID", ""),
+                        lease_seconds=settings.get("LEASE_SECONDS", 1200),
+                        snapshots_per_cycle=settings.get("SNAPSHOTS_PER_CYCLE", 2),
+                        snapshot_interval=settings.get("SNAPSHOT_INTERVAL", 12 * 3600),
+                        snapshot_max_age=settings.get("SNAPSHOT_MAX_AGE", 24 * 3600),
+                        image_format=settings.get("IMAGE_FORMAT", "png"),
+                        max_queue_size=settings.get("MAX_QUEUE_SIZE", 500),
+                        polling_mode=settings.get("POLLING_MODE", "member"),
+                        team_feed_page_size=settings.get("TEAM_FEED_PAGE_SIZE", 100),
+                        team_feed_max_entries=settings.get("TEAM_FEED_MAX_ENTRIES", 800),
+                        ranking_page_size=settings.get("RANKING_PAGE_SIZE", 25),
+                        render_workers=settings.get("RENDER_WORKERS", 4),
+                        log_level=settings.get("LOG_LEVEL", "DEBUG"),
+                        log_max_bytes=settings.get("LOG_MAX_BYTES", 10 * 1024 * 1024),
+                        log_backup_count=settings.get("LOG_BACKUP_COUNT", 5),
+                        coalesce_window=settings.get("COALESCE_WINDOW", 600),
+                        health_port=settings.get("HEALTH_PORT", 8080),
+                        phase_timeout=settings.get("PHASE_TIMEOUT", 900),
+                        watchdog_action=settings.get("WATCHDOG_ACTION", "exit"),
+                        catchup_min_gap=settings.get("CATCHUP_MIN_GAP", 2 * 3600),
+                        catchup_max_pages=settings.get("CATCHUP_MAX_PAGES", 10),
+                        catchup_digest_threshold=settings.get("CATCHUP_DIGEST_THRESHOLD", 20),
+                        catchup_batch_size=settings.get("CATCHUP_BATCH_SIZE", 5),
+                        catchup_batch_delay=settings.get("CATCHUP_BATCH_DELAY", 5),
+                        embed_mode_queue_size=settings.get("EMBED_MODE_QUEUE_SIZE", 30),
+                        embed_mode_age=settings.get("EMBED_MODE_AGE", 600),
+                        stats_api_port=settings.get("STATS_API_PORT", 0),
+                        dry_run=args.dry_run)
+
+    if args.command == "run":
+        pwngress.loop()
+        return
+
+    if args.command == "cycle":
+        phase_duration = pwngress.run_phase("cycle", pwngress.run_cycle)
+    else:
+        pwngress.start_cycle()
+        if args.command == "sync":
+            phase_duration = pwngress.run_phase("sync", pwngress.get_and_save_team_members)
+        elif args.command == "poll":
+            phase_duration = pwngress.run_phase("poll", pwngress.check_each_team_member_solves)
+            phase_duration += pwngress.run_phase("send", pwngress.send_member_solves_messages)
+        elif args.command == "snapshots":
+            phase_duration = pwngress.run_phase("snapshots", pwngress.collect_member_snapshots)
+        elif args.command == "ranking":
+            phase_duration = pwngress.run_phase("ranking", pwngress.run_weekly_ranking)
+        print("[+] {} finished in {:.2f} sec".format(args.command, phase_duration))
 
 
 if __name__ == "__main__":
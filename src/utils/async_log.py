@@ -0,0 +1,163 @@
+"""
+Non-blocking log. Messages are put on a queue and written to the log file by a background thread in
+batches. Formatting is done by the writer thread and only for enabled levels, so disabled debug messages
+cost one comparison on the polling thread.
+"""
+
+from datetime import datetime
+import atexit
+import os
+import queue
+import threading
+
+
+LOG_LEVELS = {
+    "DEBUG": 10,
+    "INFO": 20,
+    "WARNING": 30,
+    "ERROR": 40
+}
+
+
+class AsyncLog():
+    """
+    Log with the same interface as Lumberjack (debug/info/warning/error). Messages use str.format
+    placeholders and the arguments are passed separately:
+
+        log.debug("Checking user activities {} ({})", member_name, user_id)
+
+    The log file is rotated when it grows over max_bytes (PWNgress_events.log.1 ... .backup_count).
+    If the queue is full (disk stalled) messages are dropped and the number of dropped messages is logged
+    once the writer catches up. Messages that failed to be written (e.g. full disk) are counted and logged
+    the same way.
+    """
+
+    def __init__(self, log_path, level="INFO", max_bytes=10 * 1024 * 1024, backup_count=5, queue_size=10000,
+                 batch_size=500, flush_interval=1.0):
+        self.log_path = log_path
+        self.level = LOG_LEVELS[level.upper()]
+        self.max_bytes = int(max_bytes)
+        self.backup_count = int(backup_count)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.write_errors = 0
+
+        self.log_file = open(self.log_path, "a")
+        self.writer = threading.Thread(target=self.write_loop, name="AsyncLog", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def debug(self, message, *args):
+        if self.level <= 10:
+            self.enqueue("DEBUG", message, args)
+
+    def info(self, message, *args):
+        if self.level <= 20:
+            self.enqueue("INFO", message, args)
+
+    def warning(self, message, *args):
+        if self.level <= 30:
+            self.enqueue("WARNING", message, args)
+
+    def error(self, message, *args):
+        if self.level <= 40:
+            self.enqueue("ERROR", message, args)
+
+    def enqueue(self, level, message, args):
+        try:
+            self.queue.put_nowait((datetime.now(), level, message, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def format_record(self, record):
+        log_date, level, message, args = record
+        if args:
+            try:
+                message = message.format(*args)
+            except (IndexError, KeyError, ValueError):
+                message = "{} {}".format(message, args)
+
+        return "{} [{}] {}\n".format(log_date.strftime("%Y-%m-%d %H:%M:%S"), level, message)
+
+    def write_loop(self):
+        """
+        Writer thread. Waits for the first message, then takes everything queued (up to batch_size) and
+        writes it with one flush.
+        """
+
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            records = []
+            stop = record is None
+            while not stop:
+                records.append(record)
+                if len(records) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                stop = record is None
+
+            if records:
+                try:
+                    self.write_records(records)
+                except (OSError, ValueError):
+                    # Full disk or missing log volume. Keep the writer running, messages are lost
+                    self.write_errors += len(records)
+            if stop:
+                return
+
+    def write_records(self, records):
+        lines = [self.format_record(record) for record in records]
+        if self.dropped:
+            lines.append(self.format_record(
+                (datetime.now(), "WARNING", "Log queue was full, {} messages dropped", (self.dropped,))
+            ))
+        if self.write_errors:
+            lines.append(self.format_record(
+                (datetime.now(), "WARNING", "Log file write failed, {} messages lost", (self.write_errors,))
+            ))
+
+        # Rotation could have failed to reopen the file
+        if self.log_file.closed:
+            self.log_file = open(self.log_path, "a")
+        self.log_file.write("".join(lines))
+        self.log_file.flush()
+        self.dropped = 0
+        self.write_errors = 0
+
+        if self.log_file.tell() > self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        """
+        Rotate log files: PWNgress_events.log -> .1 -> .2 ... The oldest file is removed.
+        """
+
+        self.log_file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.log_path, i)):
+                os.replace("{}.{}".format(self.log_path, i), "{}.{}".format(self.log_path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.log_path, "{}.1".format(self.log_path))
+        else:
+            os.remove(self.log_path)
+        self.log_file = open(self.log_path, "a")
+
+    def close(self):
+        """
+        Write everything that is queued and stop the writer thread.
+        """
+
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.log_file.close()
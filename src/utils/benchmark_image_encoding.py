@@ -0,0 +1,109 @@
+"""
+Compare encode time and size of the image formats (IMAGE_FORMAT setting) for notification cards and
+the ranking table. Runs offline with fixture images and avatars.
+
+    cd src && python3 -m utils.benchmark_image_encoding --font /path/to/font.ttf
+"""
+
+import argparse
+import re
+import statistics
+import tempfile
+import time
+
+from PWNgress import PWNgress
+from utils.image_encoding import IMAGE_FORMATS, encode_image
+from utils.render_fixtures import create_fixture_images, fixture_avatar
+
+
+class BenchmarkPWNgress(PWNgress):
+    """
+    PWNgress used only for rendering. Doesn't connect to the database or start the loop and returns
+    fixture avatars instead of downloading images.
+    """
+
+    def __init__(self, font, images_dir):
+        self.font_htb_name = font
+        self.font_message = font
+        self.font_table_header = font
+        self.font_table_names = font
+        self.font_table_data = font
+        self.images_dir = images_dir
+        self.image_format = "png"
+        self.render_workers = 4
+        self.render_executor = None
+
+    def fetch_image(self, image_url):
+        return fixture_avatar(int(re.sub("[^0-9]", "", image_url) or 0))
+
+    def error_handler(self, error_message, traceback_message):
+        raise RuntimeError(error_message + "\n" + traceback_message)
+
+
+def benchmark_table_data(rows):
+    """
+    Ranking table with the given number of member rows and links to fixture avatars.
+    """
+
+    table_data = [["NAME", "RNK", "PNT", "USR", "SYS", "CHL", "FRT", "END", "PRO"]]
+    for i in range(rows):
+        table_data.append(
+            ["member_{}".format(i), "{} ({:+d})".format(100 + i * 37, i % 7 - 3).replace("(+0)", "(0)")] +
+            ["{} ({:+d})".format(i * 13 + j, (i + j) % 4).replace("(+0)", "(0)") for j in range(7)]
+        )
+
+    return table_data, ["https://www.hackthebox.com/storage/avatars/{}.png".format(i) for i in range(rows)]
+
+
+def time_encoding(image, image_format, repeat):
+    """
+    Return median encode time in milliseconds and encoded size in bytes.
+    """
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image_bytes = encode_image(image, image_format)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(timings), len(image_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image encodings")
+    parser.add_argument("--font", required=True, help="TrueType font used for all texts")
+    parser.add_argument("--rows", type=int, default=25, help="Member rows in the ranking table")
+    parser.add_argument("--repeat", type=int, default=5, help="Encodes per format")
+    args = parser.parse_args()
+
+    images_dir = tempfile.mkdtemp(prefix="PWNgress-bench-")
+    create_fixture_images(images_dir)
+    renderer = BenchmarkPWNgress(args.font, images_dir)
+
+    table_data, avatar_links = benchmark_table_data(args.rows)
+    images = [
+        ("create_image", renderer.render_notification_image(
+            "BenchmarkUser",
+            "https://www.hackthebox.com/storage/avatars/7.png",
+            "https://www.hackthebox.com/storage/avatars/42.png",
+            ["Owned ", "ROOT ", "Benchmark machine"]
+        )),
+        ("create_table_image", renderer.render_table_image(
+            table_data, renderer.fetch_avatar_images(avatar_links)
+        ))
+    ]
+
+    print("{:<20s} {:<15s} {:>10s} {:>10s} {:>8s}".format("IMAGE", "FORMAT", "ENCODE MS", "BYTES", "VS PNG"))
+    for image_name, image in images:
+        png_size = None
+        for image_format in IMAGE_FORMATS:
+            encode_ms, image_size = time_encoding(image, image_format, args.repeat)
+            png_size = png_size or image_size
+            print("{:<20s} {:<15s} {:>10.2f} {:>10d} {:>7.0f}%".format(
+                image_name, image_format, encode_ms, image_size, image_size * 100 / png_size
+            ))
+        image.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Coordination between PWNgress replicas. Team members are split between live replicas for polling and
+a single leader (holder of the "leader" lease) runs the weekly ranking and sends Discord notifications.
+"""
+
+from collections import OrderedDict
+import time
+
+from utils import htb_models
+
+
+class LocalCoordinator():
+    """
+    Stand-in coordinator for a single replica. It owns all members and is always the leader.
+    """
+
+    def __init__(self, replica_id="local"):
+        self.replica_id = replica_id
+
+    def start_cycle(self):
+        """
+        Refresh replica membership and leadership. Called at the start of every polling cycle.
+        """
+
+        pass
+
+    def keep_alive(self):
+        """
+        Renew replica heartbeat and leadership. Called between phases and while sleeping.
+        """
+
+        pass
+
+    def is_leader(self):
+        return True
+
+    def owns_member(self, member_id):
+        return True
+
+    def share_messages(self, message_queue, limit):
+        """
+        Return messages this replica should send.
+        """
+
+        return message_queue
+
+    def mark_delivered(self, queue_keys):
+        pass
+
+
+class DatabaseCoordinator():
+    """
+    Coordinator using the shared SQLite database (tables replicas, leases and notification_queue).
+    Leadership is a lease taken with a conditional UPDATE, so only one replica can hold it at a time.
+    The heartbeat and the lease are renewed between phases and while sleeping (keep_alive), so
+    lease_seconds has to be longer than the longest phase (PHASE_TIMEOUT), otherwise other replicas will
+    consider a busy replica dead.
+    """
+
+    def __init__(self, db, log, replica_id, lease_seconds=1200):
+        self.db = db
+        self.log = log
+        self.replica_id = replica_id
+        self.lease_seconds = float(lease_seconds)
+
+        self.leader = False
+        self.replica_index = 0
+        self.replica_count = 1
+
+    def start_cycle(self):
+        """
+        Send replica heartbeat, take or renew the leader lease and calculate this replica's shard.
+        """
+
+        now = time.time()
+
+        self.send_heartbeat(now)
+
+        # Take the lease if we already hold it or if it expired. SQLite serializes writes so only one
+        # replica can win an expired lease
+        self.db.update(
+            "leases",
+            OrderedDict([("holder", self.replica_id), ("expires", now + self.lease_seconds)]),
+            "name = 'leader' AND (holder = '{}' OR expires < {})".format(self.replica_id, now)
+        )
+        lease_rows = self.db.select("holder", "leases", "name = 'leader'")
+        was_leader = self.leader
+        self.leader = bool(lease_rows) and lease_rows[0][0] == self.replica_id
+        if self.leader != was_leader:
+            self.log.info("Replica {} is {} the leader", self.replica_id, "now" if self.leader else "no longer")
+
+        live_replicas = [x[0] for x in self.db.select(
+            "replica_id",
+            "replicas",
+            "heartbeat > {} ORDER BY replica_id ASC".format(now - self.lease_seconds)
+        )]
+        if self.replica_id in live_replicas:
+            self.replica_index = live_replicas.index(self.replica_id)
+            self.replica_count = len(live_replicas)
+        self.log.debug("Replica {} polls shard {}/{}", self.replica_id, self.replica_index, self.replica_count)
+
+        if self.leader:
+            # Forget replicas that are gone for a long time and old delivered notifications
+            self.db.delete("replicas", "heartbeat < {}".format(now - 10 * self.lease_seconds))
+            self.db.delete("notification_queue", "delivered = 1 AND queued_at < {}".format(now - 7 * 24 * 3600))
+
+    def send_heartbeat(self, now):
+        if self.db.select("replica_id", "replicas", "replica_id = '{}'".format(self.replica_id)):
+            self.db.update(
+                "replicas",
+                OrderedDict([("heartbeat", now)]),
+                "replica_id = '{}'".format(self.replica_id)
+            )
+        else:
+            self.db.insert("replicas", OrderedDict([("replica_id", self.replica_id), ("heartbeat", now)]))
+
+    def keep_alive(self):
+        """
+        Send replica heartbeat and renew the leader lease if this replica holds it. Leadership and shards
+        change only at the start of a cycle.
+        """
+
+        now = time.time()
+
+        self.send_heartbeat(now)
+        if self.leader:
+            self.db.update(
+                "leases",
+                OrderedDict([("expires", now + self.lease_seconds)]),
+                "name = 'leader' AND holder = '{}'".format(self.replica_id)
+            )
+
+    def is_leader(self):
+        return self.leader
+
+    def owns_member(self, member_id):
+        return int(member_id) % self.replica_count == self.replica_index
+
+    def share_messages(self, message_queue, limit):
+        """
+        Publish messages found by this replica to the shared queue. The leader gets back up to limit oldest
+        messages that were not delivered yet, other replicas get nothing to send.
+        """
+
+        for queue_key, message_data in message_queue.items():
+            # The same solve is found again until the leader updates last_flag_date
+            if self.db.select("queue_key", "notification_queue", "queue_key = '{}'".format(queue_key)):
+                continue
+            self.db.insert(
+                "notification_queue",
+                OrderedDict([
+                    ("queue_key", queue_key),
+                    ("member_id", message_data["member_id"]),
+                    ("member_name", message_data["member_name"]),
+                    ("activity_data", htb_models.dumps(message_data["activity_data"].to_dict())),
+                    ("queued_at", message_data["queued_at"]),
+                    ("delivered", 0)
+                ])
+            )
+
+        if not self.leader:
+            return {}
+
+        shared_queue = {}
+        for queue_row in self.db.select(
+            "queue_key, member_id, member_name, activity_data, queued_at",
+            "notification_queue",
+            "delivered = 0 ORDER BY queue_key ASC LIMIT {}".format(int(limit))
+        ):
+            shared_queue[queue_row[0]] = {
+                "member_id": queue_row[1],
+                "member_name": queue_row[2],
+                "activity_data": htb_models.Activity(**htb_models.loads(queue_row[3])),
+                "queued_at": queue_row[4]
+            }
+
+        return shared_queue
+
+    def mark_delivered(self, queue_keys):
+        for queue_key in queue_keys:
+            self.db.update(
+                "notification_queue",
+                OrderedDict([("delivered", 1)]),
+                "queue_key = '{}'".format(queue_key)
+            )
@@ -0,0 +1,156 @@
+"""
+In-process liveness monitoring. The polling loop reports progress to a Heartbeat, a small HTTP server
+exposes it for Docker HEALTHCHECK (/health, /ready) and a watchdog thread reacts when the loop stalls.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+class Heartbeat():
+    """
+    Progress of the polling loop. Every beat says by when the next one is expected: a started phase has
+    phase_timeout seconds to finish, a sleeping loop has the sleep time plus phase_timeout to start the next
+    phase. The loop is stalled when the expected beat didn't come.
+    """
+
+    def __init__(self, phase_timeout=900):
+        self.phase_timeout = float(phase_timeout)
+        self.lock = threading.Lock()
+
+        self.started = time.time()
+        self.last_beat = self.started
+        self.next_beat_deadline = self.started + self.phase_timeout
+        self.current_phase = ""
+        self.phase_finished_times = {}
+        self.cycles = 0
+        self.last_cycle_time = None
+
+    def beat(self, expected_within):
+        self.last_beat = time.time()
+        self.next_beat_deadline = self.last_beat + expected_within
+
+    def phase_started(self, phase_name):
+        with self.lock:
+            self.current_phase = phase_name
+            self.beat(self.phase_timeout)
+
+    def phase_finished(self, phase_name):
+        with self.lock:
+            self.current_phase = ""
+            self.beat(self.phase_timeout)
+            self.phase_finished_times[phase_name] = self.last_beat
+
+    def phase_progress(self):
+        """
+        Called by long phases after every unit of work (e.g. a member), the phase gets another phase_timeout
+        seconds.
+        """
+
+        with self.lock:
+            self.beat(self.phase_timeout)
+
+    def cycle_finished(self):
+        with self.lock:
+            self.beat(self.phase_timeout)
+            self.cycles += 1
+            self.last_cycle_time = self.last_beat
+
+    def sleeping(self, sleep_seconds):
+        with self.lock:
+            self.current_phase = "sleep"
+            self.beat(sleep_seconds + self.phase_timeout)
+
+    def stalled_for(self):
+        """
+        Return number of seconds the expected beat is late (0 if the loop is not stalled).
+        """
+
+        return max(time.time() - self.next_beat_deadline, 0)
+
+    def status(self):
+        """
+        Return health status as dictionary. live - loop is not stalled, ready - loop is live and finished
+        at least one cycle.
+        """
+
+        now = time.time()
+        with self.lock:
+            stalled_for = max(now - self.next_beat_deadline, 0)
+            return {
+                "live": stalled_for == 0,
+                "ready": stalled_for == 0 and self.cycles > 0,
+                "stalled_for": round(stalled_for, 1),
+                "current_phase": self.current_phase,
+                "seconds_since_last_beat": round(now - self.last_beat, 1),
+                "seconds_since_last_cycle": round(now - self.last_cycle_time, 1) if self.last_cycle_time else None,
+                "seconds_since_phase": {
+                    phase_name: round(now - finished_time, 1)
+                    for phase_name, finished_time in self.phase_finished_times.items()
+                },
+                "cycles": self.cycles,
+                "uptime": round(now - self.started, 1)
+            }
+
+
+def serve_health(heartbeat, host="0.0.0.0", port=8080):
+    """
+    Start health HTTP server in a daemon thread. GET /health returns 200 while the loop is live, GET /ready
+    returns 200 once the loop finished a cycle and is live, otherwise 503. Body is the status as JSON.
+    Returns the server.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path not in ["/health", "/ready"]:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            health_status = heartbeat.status()
+            healthy = health_status["live"] if path == "/health" else health_status["ready"]
+            body = json.dumps(health_status).encode()
+
+            self.send_response(200 if healthy else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    threading.Thread(target=server.serve_forever, name="HealthServer", daemon=True).start()
+
+    return server
+
+
+class Watchdog():
+    """
+    Thread checking the heartbeat every check_interval seconds. When the loop stalls on_stall(status) is
+    called once per stall. on_stall decides whether to only alert or to exit the process for a restart.
+    """
+
+    def __init__(self, heartbeat, on_stall, check_interval=10):
+        self.heartbeat = heartbeat
+        self.on_stall = on_stall
+        self.check_interval = float(check_interval)
+        self.stalled = False
+
+        self.thread = threading.Thread(target=self.watch, name="Watchdog", daemon=True)
+        self.thread.start()
+
+    def watch(self):
+        while True:
+            time.sleep(self.check_interval)
+
+            if self.heartbeat.stalled_for() > 0:
+                if not self.stalled:
+                    self.stalled = True
+                    self.on_stall(self.heartbeat.status())
+            else:
+                self.stalled = False
@@ -0,0 +1,199 @@
+"""
+Decoding layer for HTB API payloads. Responses are decoded straight from bytes with the fastest
+available JSON codec and only the fields PWNgress uses are kept in small slotted models.
+"""
+
+try:
+    import orjson
+
+    def loads(data):
+        """
+        Decode JSON document (bytes or str).
+        """
+
+        return orjson.loads(data)
+
+    def dumps(obj):
+        """
+        Encode object as compact JSON string.
+        """
+
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+
+    def loads(data):
+        """
+        Decode JSON document (bytes or str).
+        """
+
+        return json.loads(data)
+
+    def dumps(obj):
+        """
+        Encode object as compact JSON string.
+        """
+
+        return json.dumps(obj, separators=(",", ":"))
+
+
+HTB_URL = "https://www.hackthebox.com"
+
+
+class TeamMember():
+    """
+    Team member from /team/members/{team_id}.
+    """
+
+    __slots__ = ("id", "name", "avatar", "points")
+
+    def __init__(self, id, name, avatar, points):
+        self.id = id
+        self.name = name
+        self.avatar = avatar
+        self.points = points
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["name"], HTB_URL + data["avatar"], data["points"])
+
+    def to_json(self):
+        """
+        Compact JSON representation saved in htb_team_members.json_data.
+        """
+
+        return dumps({"id": self.id, "name": self.name, "avatar": self.avatar, "points": self.points})
+
+
+class ProfileBasic():
+    """
+    User profile from /user/profile/basic/{user_id}.
+    """
+
+    __slots__ = ("ranking", "user_owns", "system_owns", "user_bloods", "system_bloods", "respects")
+
+    def __init__(self, ranking, user_owns, system_owns, user_bloods, system_bloods, respects):
+        self.ranking = ranking
+        self.user_owns = user_owns
+        self.system_owns = system_owns
+        self.user_bloods = user_bloods
+        self.system_bloods = system_bloods
+        self.respects = respects
+
+    @classmethod
+    def from_json(cls, data):
+        profile = data["profile"]
+        return cls(profile["ranking"], profile["user_owns"], profile["system_owns"],
+                   profile["user_bloods"], profile["system_bloods"], profile["respects"])
+
+
+class Activity():
+    """
+    Single solve from /user/profile/activity/{user_id}. Fields that don't apply to the object type
+    (e.g. machine_avatar for challenges) are empty strings.
+    """
+
+    __slots__ = ("date", "object_type", "type", "name", "machine_avatar", "challenge_category", "flag_title")
+
+    def __init__(self, date, object_type, type, name, machine_avatar="", challenge_category="", flag_title=""):
+        self.date = date
+        self.object_type = object_type
+        self.type = type
+        self.name = name
+        self.machine_avatar = machine_avatar
+        self.challenge_category = challenge_category
+        self.flag_title = flag_title
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            data["date"],
+            data["object_type"],
+            data.get("type") or "",
+            data.get("name") or "",
+            data.get("machine_avatar") or "",
+            data.get("challenge_category") or "",
+            data.get("flag_title") or ""
+        )
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def parse_team_members(data):
+    """
+    Parse team members payload into list of TeamMember.
+    """
+
+    return [TeamMember.from_json(member_data) for member_data in loads(data)]
+
+
+def parse_profile_basic(data):
+    """
+    Parse basic profile payload into ProfileBasic.
+    """
+
+    return ProfileBasic.from_json(loads(data))
+
+
+def parse_activities(data):
+    """
+    Parse activity payload into list of Activity, newest first (same order as the API).
+    """
+
+    return [Activity.from_json(activity_data) for activity_data in loads(data)["profile"]["activity"]]
+
+
+def parse_team_activities(data):
+    """
+    Parse team activity feed payload into list of (member_id, Activity), newest first.
+    """
+
+    return [
+        (activity_data["user"]["id"], Activity.from_json(activity_data))
+        for activity_data in loads(data)
+    ]
+
+
+def parse_challenge_owns(data):
+    """
+    Parse challenges progress payload and return number of solved challenges.
+    """
+
+    return loads(data)["profile"]["challenge_owns"]["solved"]
+
+
+def parse_owned_flags(data, progress_type):
+    """
+    Parse fortress/endgame/prolab progress payload and return sum of owned flags.
+    progress_type - key of the list in the profile ("fortresses", "endgames" or "prolabs").
+    """
+
+    return sum(progress["owned_flags"] for progress in loads(data)["profile"][progress_type])
+
+
+class TeamStats():
+    """
+    Team ranking built from /team/info/{team_id} and /team/stats/owns/{team_id}.
+    """
+
+    __slots__ = ("rank", "points", "user_owns", "system_owns", "challenge_owns", "respects")
+
+    def __init__(self, rank, points, user_owns, system_owns, challenge_owns, respects):
+        self.rank = rank
+        self.points = points
+        self.user_owns = user_owns
+        self.system_owns = system_owns
+        self.challenge_owns = challenge_owns
+        self.respects = respects
+
+
+def parse_team_stats(info_data, stats_data):
+    """
+    Parse team info and team stats payloads into TeamStats.
+    """
+
+    team_info = loads(info_data)
+    team_stats = loads(stats_data)
+    return TeamStats(team_stats["rank"], team_info["points"], team_stats["user_owns"],
+                     team_stats["system_owns"], team_stats["challenge_owns"], team_stats["respects"])
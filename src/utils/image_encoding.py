@@ -0,0 +1,58 @@
+"""
+Output encodings for notification and ranking images. All of them are lossless for the images PWNgress
+creates (the palette variant is lossless as long as the image has at most 256 colors, otherwise the
+anti-aliased text edges are approximated).
+"""
+
+import io
+
+from PIL import Image
+
+
+# Encoding name -> file extension
+IMAGE_FORMATS = {
+    "png": "png",
+    "png-optimized": "png",
+    "png-palette": "png",
+    "webp-lossless": "webp"
+}
+
+
+def encode_image(image, image_format="png"):
+    """
+    Encode PIL image and return bytes.
+    png           - Pillow defaults (zlib level 6)
+    png-optimized - zlib level 9 with optimize pass
+    png-palette   - quantized to 256 colors, optimized
+    webp-lossless - lossless WebP
+    """
+
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError("Unknown image format " + image_format)
+
+    image_bytes = io.BytesIO()
+    if image_format == "png":
+        image.save(image_bytes, "PNG")
+    elif image_format == "png-optimized":
+        image.save(image_bytes, "PNG", optimize=True)
+    elif image_format == "png-palette":
+        # Images are drawn on an opaque background, alpha channel is not needed
+        palette_image = image.convert("RGB").quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        palette_image.save(image_bytes, "PNG", optimize=True)
+        palette_image.close()
+    elif image_format == "webp-lossless":
+        image.save(image_bytes, "WEBP", lossless=True, quality=80, method=4)
+
+    return image_bytes.getvalue()
+
+
+def save_image(image, filename_without_extension, image_format="png"):
+    """
+    Encode PIL image and save it. Returns the filename with extension of the used format.
+    """
+
+    filename = "{}.{}".format(filename_without_extension, IMAGE_FORMATS[image_format])
+    with open(filename, "wb") as image_file:
+        image_file.write(encode_image(image, image_format))
+
+    return filename
@@ -8,6 +8,8 @@ DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
 DISCORD_WEBHOOK_URL_ALERTS=`grep 'DISCORD_WEBHOOK_URL_ALERTS=' $DIR/../settings/PWNgress_settings.cfg | cut -d '=' -f 2`
 
+# A stuck polling loop is detected by the watchdog inside PWNgress (it alerts and exits, Docker restarts the
+# container). This script only covers the container being down, including restarts that keep failing
 while true
 do
     if [ "$( docker container inspect -f '{{.State.Status}}' $CONTAINER_NAME )" != "running" ]
@@ -16,6 +18,12 @@ do
             -H "Content-Type: application/json" \
             -d '{"embeds": [{"title": "PWNgress container is down", "color": 16711680}]}' \
             $DISCORD_WEBHOOK_URL_ALERTS
+    elif [ "$( docker container inspect -f '{{.State.Health.Status}}' $CONTAINER_NAME )" == "unhealthy" ]
+    then
+        curl -X POST \
+            -H "Content-Type: application/json" \
+            -d '{"embeds": [{"title": "PWNgress container is unhealthy", "color": 16711680}]}' \
+            $DISCORD_WEBHOOK_URL_ALERTS
     fi
-    sleep 1800
+    sleep 300
 done
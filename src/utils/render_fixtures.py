@@ -0,0 +1,68 @@
+"""
+Deterministic stand-ins for the images PWNgress renders with (images volume and HTB avatars), so image
+rendering can be benchmarked and checked offline.
+"""
+
+import os
+
+from PIL import Image, ImageDraw
+
+
+CHALLENGE_CATEGORIES = [
+    "crypto",
+    "forensics",
+    "gamepwn",
+    "hardware",
+    "misc",
+    "mobile",
+    "osint",
+    "pwn",
+    "reversing",
+    "web"
+]
+
+
+def create_fixture_images(images_dir):
+    """
+    Create avatar frame, ranking arrows and flag type images in images_dir.
+    """
+
+    os.makedirs(images_dir, exist_ok=True)
+
+    frame_image = Image.new("RGBA", (200, 200), (0, 0, 0, 0))
+    ImageDraw.Draw(frame_image).ellipse([(10, 10), (190, 190)], outline=(159, 239, 0, 255), width=12)
+    frame_image.save(os.path.join(images_dir, "avatar_frame.png"))
+
+    arrow_up_image = Image.new("RGBA", (50, 50), (0, 0, 0, 0))
+    ImageDraw.Draw(arrow_up_image).polygon([(25, 5), (45, 45), (5, 45)], fill=(167, 253, 48, 255))
+    arrow_up_image.save(os.path.join(images_dir, "arrow_up.png"))
+    arrow_down_image = Image.new("RGBA", (50, 50), (0, 0, 0, 0))
+    ImageDraw.Draw(arrow_down_image).polygon([(5, 5), (45, 5), (25, 45)], fill=(245, 59, 60, 255))
+    arrow_down_image.save(os.path.join(images_dir, "arrow_down.png"))
+
+    flag_colors = {"fortress": (148, 0, 255, 255), "endgame": (0, 134, 255, 255)}
+    for flag_type in CHALLENGE_CATEGORIES + ["fortress", "endgame"]:
+        flag_image = Image.new("RGBA", (75, 75), (0, 0, 0, 0))
+        flag_draw = ImageDraw.Draw(flag_image)
+        flag_color = flag_colors.get(flag_type, (159, 239, 0, 255))
+        # Different shape per type so each card is distinguishable
+        sides = 3 + len(flag_type) % 5
+        flag_draw.regular_polygon((37, 37, 32), sides, fill=flag_color)
+        flag_image.save(os.path.join(images_dir, "{}.png".format(flag_type)))
+
+
+def fixture_avatar(seed, size=200):
+    """
+    Return deterministic RGBA avatar image for the given integer seed.
+    """
+
+    avatar_color = ((seed * 67) % 256, (seed * 131) % 256, (seed * 29) % 256, 255)
+    avatar_image = Image.new("RGBA", (size, size), avatar_color)
+    avatar_draw = ImageDraw.Draw(avatar_image)
+    for i in range(8):
+        avatar_draw.rectangle(
+            [(i * size // 8, (seed * (i + 3)) % size), ((i + 1) * size // 8, size)],
+            fill=((seed + i * 40) % 256, (seed * 7 + i * 20) % 256, 255 - (seed + i * 30) % 256)
+        )
+
+    return avatar_image
@@ -0,0 +1,261 @@
+"""
+Golden-image regression suite for notification cards and ranking tables. Every card type and ranking
+tables of 5, 25 and 100 rows are rendered offline with fixture images and avatars, compared pixel by pixel
+with golden images and checked against time and memory budgets. Linux only (memory is peak RSS from /proc).
+
+Golden images, the timing baseline (timings.json) and the font they are rendered with (DejaVu Sans) are
+in render_golden. Golden images depend on the Pillow version, after a Pillow upgrade (or on a much slower
+or faster machine) regenerate them with --update and check the changed images. --update also saves render
+times of this machine as the timing baseline, later runs fail if a case is more than --time-tolerance
+(plus --time-slack-ms) slower. Without a baseline the fixed time budgets are used:
+
+    cd src && python3 -m utils.render_suite
+    cd src && python3 -m utils.render_suite --update
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import PIL
+from PIL import Image, ImageChops
+
+from utils.benchmark_image_encoding import BenchmarkPWNgress, benchmark_table_data
+from utils.htb_models import Activity
+from utils.render_fixtures import CHALLENGE_CATEGORIES, create_fixture_images
+
+
+TABLE_ROWS = [5, 25, 100]
+
+
+def card_activities():
+    """
+    Return list of (case name, [Activity, ...]) covering every notification card type.
+    """
+
+    date = "2024-01-01T00:00:00.000Z"
+    machine_avatar = "/storage/avatars/42_thumb.png"
+    cases = [
+        ("card_machine_user", [Activity(date, "machine", "user", "Golden", machine_avatar)]),
+        ("card_machine_root", [Activity(date, "machine", "root", "Golden", machine_avatar)]),
+        ("card_machine_user_root", [
+            Activity(date, "machine", "user", "Golden", machine_avatar),
+            Activity(date, "machine", "root", "Golden", machine_avatar)
+        ])
+    ]
+    for category in CHALLENGE_CATEGORIES:
+        cases.append(("card_challenge_{}".format(category), [
+            Activity(date, "challenge", "", "Golden {}".format(category), challenge_category=category)
+        ]))
+    cases.append(("card_fortress", [
+        Activity(date, "fortress", "", "Cyber Attack Simulation Golden", flag_title="Golden Flag")
+    ]))
+    cases.append(("card_endgame", [Activity(date, "endgame", "", "Golden", flag_title="Golden Flag")]))
+
+    return cases
+
+
+def render_cases(renderer):
+    """
+    Return list of (case name, budget kind, rows, render function). Rows is 0 for notification cards.
+    """
+
+    cases = []
+    for case_name, activities in card_activities():
+        if len(activities) == 1:
+            message, htb_flag_type = renderer.get_solve_message(activities[0])
+        else:
+            message, htb_flag_type, text = renderer.get_coalesced_message(activities)
+        cases.append((case_name, "card", 0, lambda m=message, f=htb_flag_type: renderer.render_notification_image(
+            "GoldenUser", "https://www.hackthebox.com/storage/avatars/7.png", f, m
+        )))
+
+    for rows in TABLE_ROWS:
+        table_data, avatar_links = benchmark_table_data(rows)
+        avatar_images = renderer.fetch_avatar_images(avatar_links)
+        cases.append(("table_{}".format(rows), "table", rows, lambda t=table_data, a=avatar_images: (
+            renderer.render_table_image(t, a)
+        )))
+
+    return cases
+
+
+def measure_time(render_function, repeat):
+    """
+    Render repeat times. Returns (last image, fastest time in ms). The fastest render is the least affected
+    by other load on the machine.
+    """
+
+    timings = []
+    image = None
+    for _ in range(repeat):
+        if image:
+            image.close()
+        start = time.perf_counter()
+        image = render_function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return image, min(timings)
+
+
+def process_memory():
+    """
+    Return (RSS, peak RSS) of this process in MB.
+    """
+
+    with open("/proc/self/status", "r") as status_file:
+        status = dict(line.split(":", 1) for line in status_file.read().splitlines())
+
+    return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+
+
+def measure_memory(font, images_dir, case_name):
+    """
+    Return peak RSS growth in MB while rendering the case. Run in a new process, so the memory freed by
+    earlier renders can't be reused (Pillow allocates image memory outside of tracemalloc).
+    """
+
+    renderer = BenchmarkPWNgress(font, images_dir)
+    render_function = [x[3] for x in render_cases(renderer) if x[0] == case_name][0]
+
+    rss_before = process_memory()[0]
+    # Reset peak RSS
+    with open("/proc/self/clear_refs", "w") as clear_refs_file:
+        clear_refs_file.write("5")
+    render_function().close()
+
+    return process_memory()[1] - rss_before
+
+
+def compare_images(image, golden_filename, pixel_tolerance):
+    """
+    Compare image with the golden image. Returns (number of different pixels, difference image or None).
+    A pixel is different if any channel differs by more than pixel_tolerance.
+    """
+
+    with Image.open(golden_filename) as golden_image:
+        golden_image = golden_image.convert("RGBA")
+        if golden_image.size != image.size:
+            return image.size[0] * image.size[1], None
+
+        difference = ImageChops.difference(image.convert("RGBA"), golden_image)
+        # Largest channel difference of every pixel
+        max_difference = difference.getchannel(0)
+        for channel in difference.split()[1:]:
+            max_difference = ImageChops.lighter(max_difference, channel)
+        diff_mask = max_difference.point(lambda x: 255 if x > pixel_tolerance else 0)
+
+    return diff_mask.histogram()[255], diff_mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Golden-image render regression suite")
+    parser.add_argument("--font", default="../render_golden/fonts/DejaVuSans.ttf",
+                        help="TrueType font used for all texts")
+    parser.add_argument("--golden-dir", default="../render_golden", help="Directory with golden images")
+    parser.add_argument("--update", action="store_true", help="Save rendered images as the new golden images")
+    parser.add_argument("--repeat", type=int, default=7, help="Timed renders per case")
+    parser.add_argument("--pixel-tolerance", type=int, default=0, help="Allowed difference of a channel value")
+    parser.add_argument("--max-diff-pixels", type=int, default=0, help="Allowed number of different pixels")
+    parser.add_argument("--time-tolerance", type=float, default=1.0,
+                        help="Allowed slowdown against the timing baseline (1.0 - two times slower)")
+    parser.add_argument("--time-slack-ms", type=float, default=20.0,
+                        help="Time allowed over the baseline slowdown, fast cases are dominated by noise")
+    parser.add_argument("--card-ms", type=float, default=200.0, help="Time budget of one card without baseline")
+    parser.add_argument("--card-mb", type=float, default=5.0, help="Memory budget of one card")
+    parser.add_argument("--table-ms", type=float, default=200.0,
+                        help="Time budget of a table (without rows) without baseline")
+    parser.add_argument("--table-row-ms", type=float, default=25.0,
+                        help="Time budget of a table per row without baseline")
+    parser.add_argument("--table-mb", type=float, default=5.0, help="Memory budget of a table (without rows)")
+    parser.add_argument("--table-row-mb", type=float, default=0.5, help="Memory budget of a table per row")
+    args = parser.parse_args()
+
+    images_dir = tempfile.mkdtemp(prefix="PWNgress-render-")
+    create_fixture_images(images_dir)
+    renderer = BenchmarkPWNgress(args.font, images_dir)
+    os.makedirs(args.golden_dir, exist_ok=True)
+    # (ms, ms per row, MB, MB per row)
+    budgets = {
+        "card": (args.card_ms, 0, args.card_mb, 0),
+        "table": (args.table_ms, args.table_row_ms, args.table_mb, args.table_row_mb)
+    }
+    # Memory is measured in a new process for every case
+    memory_pool = multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1)
+
+    timings_filename = os.path.join(args.golden_dir, "timings.json")
+    baseline_timings = {}
+    if os.path.exists(timings_filename) and not args.update:
+        with open(timings_filename, "r") as timings_file:
+            baseline_timings = json.load(timings_file)
+    timings = {}
+
+    # Pillow version the golden images were rendered with
+    pillow_version_filename = os.path.join(args.golden_dir, "pillow_version.txt")
+    if os.path.exists(pillow_version_filename) and not args.update:
+        with open(pillow_version_filename, "r") as pillow_version_file:
+            golden_pillow_version = pillow_version_file.read().strip()
+        if golden_pillow_version != PIL.__version__:
+            print("[!] Golden images were rendered with Pillow {}, installed is {}".format(
+                golden_pillow_version, PIL.__version__
+            ))
+
+    failures = 0
+    print("{:<28s} {:>9s} {:>9s} {:>10s}  {}".format("CASE", "MS", "MB", "DIFF PX", "RESULT"))
+    for case_name, budget_kind, rows, render_function in render_cases(renderer):
+        image, render_ms = measure_time(render_function, args.repeat)
+        timings[case_name] = render_ms
+        peak_memory = memory_pool.apply(measure_memory, (args.font, images_dir, case_name))
+        golden_filename = os.path.join(args.golden_dir, "{}.png".format(case_name))
+
+        problems = []
+        diff_pixels = 0
+        if args.update:
+            image.save(golden_filename)
+        elif not os.path.exists(golden_filename):
+            problems.append("no golden image")
+        else:
+            diff_pixels, diff_mask = compare_images(image, golden_filename, args.pixel_tolerance)
+            if diff_pixels > args.max_diff_pixels:
+                problems.append("pixels differ")
+                if diff_mask:
+                    diff_mask.save(os.path.join(images_dir, "{}-diff.png".format(case_name)))
+
+        time_budget, row_time_budget, memory_budget, row_memory_budget = budgets[budget_kind]
+        time_budget += rows * row_time_budget
+        if case_name in baseline_timings:
+            time_budget = baseline_timings[case_name] * (1 + args.time_tolerance) + args.time_slack_ms
+        memory_budget += rows * row_memory_budget
+        # Times measured by --update are the baseline
+        if render_ms > time_budget and not args.update:
+            problems.append("over time budget ({:.0f} ms)".format(time_budget))
+        if peak_memory > memory_budget:
+            problems.append("over memory budget ({:.1f} MB)".format(memory_budget))
+        image.close()
+
+        if problems:
+            failures += 1
+        print("{:<28s} {:>9.2f} {:>9.2f} {:>10d}  {}".format(
+            case_name, render_ms, peak_memory, diff_pixels, ", ".join(problems) or "ok"
+        ))
+
+    memory_pool.close()
+
+    if args.update:
+        with open(timings_filename, "w") as timings_file:
+            json.dump(timings, timings_file, indent=4)
+        with open(pillow_version_filename, "w") as pillow_version_file:
+            pillow_version_file.write(PIL.__version__ + "\n")
+        print("[+] Golden images and timing baseline saved to {}".format(args.golden_dir))
+    if failures:
+        print("[-] ERROR: {} cases failed, difference images are in {}".format(failures, images_dir))
+        sys.exit(1)
+    print("[+] All cases passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+Soak test. Runs thousands of PWNgress cycles against a local stand-in for the HTB API and Discord webhooks
+and checks that memory (RSS) and open file descriptors stay flat and that no solve is lost (every delivered
+solve of a member is followed by the next one). Linux only (uses /proc).
+
+With --burst-every members solve more than one page of activities at once, so the older pages are requested,
+and with --fail-page-every some of these requests fail:
+
+    cd src && python3 -m utils.soak_test --font /path/to/font.ttf --cycles 200 --burst-every 7 --fail-page-every 3
+
+    cd src && python3 -m utils.soak_test --font /path/to/font.ttf --cycles 3000
+"""
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+
+from PWNgress import PWNgress
+from utils import htb_models
+from utils.render_fixtures import create_fixture_images, fixture_avatar
+
+
+class StandInAPI():
+    """
+    Minimal HTB API and Discord webhook. Every member gets a new solve every solve_every activity requests
+    and burst_size more every burst_every requests (0 - no bursts). A solve is dated when it appears.
+    Activities are paged (?page=N, 20 per page like HTB) and every fail_page_every request of an older page
+    fails (0 - never). The team feed has the newest ?n= activities of all members.
+    """
+
+    def __init__(self, members, solve_every, burst_every=0, burst_size=45, fail_page_every=0):
+        self.members = members
+        self.solve_every = solve_every
+        self.burst_every = burst_every
+        self.burst_size = burst_size
+        self.fail_page_every = fail_page_every
+        self.activity_requests = {}
+        self.solve_dates = {}
+        self.page_requests = 0
+        self.failed_pages = 0
+        self.webhook_requests = 0
+        self.lock = threading.Lock()
+
+        avatar_bytes = io.BytesIO()
+        fixture_avatar(1).save(avatar_bytes, "PNG")
+        self.avatar_png = avatar_bytes.getvalue()
+
+    def latest_solve(self, member_id):
+        """
+        Return number of the newest solve of the member.
+        """
+
+        request_count = self.activity_requests.get(member_id, 0)
+        solves = request_count // self.solve_every
+        if self.burst_every:
+            solves += request_count // self.burst_every * self.burst_size
+
+        return solves
+
+    def add_solves(self, member_id):
+        """
+        Count an activity request of the member and date its new solves (UTC, a millisecond apart).
+        Called with the lock held.
+        """
+
+        self.activity_requests[member_id] = self.activity_requests.get(member_id, 0) + 1
+        solve_dates = self.solve_dates.setdefault(member_id, [])
+        while len(solve_dates) <= self.latest_solve(member_id):
+            solve_date = datetime.now(timezone.utc).replace(tzinfo=None)
+            if solve_dates:
+                solve_date = max(solve_date, solve_dates[-1] + timedelta(milliseconds=1))
+            solve_dates.append(solve_date)
+
+    def activity(self, member_id, solve):
+        return {
+            "date": self.solve_dates[member_id][solve].strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "object_type": ["machine", "challenge", "fortress", "endgame"][solve % 4],
+            "type": ["user", "root"][solve % 2],
+            "name": "Soak{}".format(solve),
+            "machine_avatar": "/storage/avatars/{}_thumb.png".format(solve),
+            "challenge_category": "Web",
+            "flag_title": "Flag {}".format(solve)
+        }
+
+    def activities(self, member_id, page=1):
+        """
+        Return activities payload of the member or None if the request fails. Only requests of the first
+        page add new solves.
+        """
+
+        with self.lock:
+            if page == 1:
+                self.add_solves(member_id)
+            else:
+                self.page_requests += 1
+                if self.fail_page_every and self.page_requests % self.fail_page_every == 0:
+                    self.failed_pages += 1
+                    return None
+
+            # Newest first, 20 per page like HTB
+            newest_solve = len(self.solve_dates.get(member_id, [])) - 1 - 20 * (page - 1)
+            activities = [
+                self.activity(member_id, solve) for solve in range(newest_solve, max(newest_solve - 20, -1), -1)
+            ]
+
+        return {"profile": {"activity": activities}}
+
+    def team_activities(self, entries_count):
+        """
+        Return team activity feed payload with the newest entries_count activities of all members.
+        """
+
+        with self.lock:
+            for member_id in range(1, self.members + 1):
+                self.add_solves(member_id)
+
+            team_solves = sorted(
+                [
+                    (solve_date, member_id, solve)
+                    for member_id, solve_dates in self.solve_dates.items()
+                    for solve, solve_date in enumerate(solve_dates)
+                ],
+                reverse=True
+            )[:entries_count]
+
+            return [
+                dict(self.activity(member_id, solve), user={"id": member_id, "name": "soak_{}".format(member_id)})
+                for solve_date, member_id, solve in team_solves
+            ]
+
+    def route(self, request_path):
+        """
+        Return (status, content type, body) for GET request path.
+        """
+
+        url = urlsplit(request_path)
+        path = url.path
+        query_args = parse_qs(url.query)
+        page = int(query_args.get("page", ["1"])[0])
+
+        api_routes = [
+            (r"/api/v4/team/members/\d+", lambda x: [
+                {"id": member_id, "name": "soak_{}".format(member_id), "avatar": "/storage/avatars/m{}.png".format(member_id),
+                 "points": member_id * 10}
+                for member_id in range(1, self.members + 1)
+            ]),
+            (r"/api/v4/user/profile/basic/(\d+)", lambda x: {"profile": {
+                "ranking": int(x), "user_owns": 1, "system_owns": 1, "user_bloods": 0, "system_bloods": 0,
+                "respects": 1
+            }}),
+            (r"/api/v4/user/profile/activity/(\d+)", lambda x: self.activities(int(x), page)),
+            (r"/api/v4/team/activity/\d+", lambda x: self.team_activities(int(query_args.get("n", ["100"])[0]))),
+            (r"/api/v4/user/profile/progress/challenges/\d+", lambda x: {"profile": {"challenge_owns": {"solved": 3}}}),
+            (r"/api/v4/user/profile/progress/fortress/\d+", lambda x: {"profile": {"fortresses": [{"owned_flags": 1}]}}),
+            (r"/api/v4/user/profile/progress/endgame/\d+", lambda x: {"profile": {"endgames": [{"owned_flags": 1}]}}),
+            (r"/api/v4/user/profile/progress/prolab/\d+", lambda x: {"profile": {"prolabs": [{"owned_flags": 1}]}}),
+            (r"/api/v4/team/info/\d+", lambda x: {"points": 100}),
+            (r"/api/v4/team/stats/owns/\d+", lambda x: {
+                "rank": 1, "user_owns": 1, "system_owns": 1, "challenge_owns": 1, "respects": 1
+            })
+        ]
+        for route_pattern, route_data in api_routes:
+            route_match = re.fullmatch(route_pattern, path)
+            if route_match:
+                data = route_data(*(route_match.groups() or [None]))
+                if data is None:
+                    return 500, "text/plain", b"server error"
+                return 200, "application/json", json.dumps(data).encode()
+
+        if path.startswith("/storage/avatars/"):
+            return 200, "image/png", self.avatar_png
+
+        return 404, "text/plain", b"not found"
+
+    def serve(self):
+        """
+        Start HTTP server in a daemon thread. Returns the server (server_address has the port).
+        """
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, content_type, body = stand_in.route(self.path)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stand_in.lock:
+                    stand_in.webhook_requests += 1
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server
+
+
+def process_resources():
+    """
+    Return RSS in MB and number of open file descriptors of this process.
+    """
+
+    with open("/proc/self/statm", "r") as statm_file:
+        rss_pages = int(statm_file.read().split()[1])
+
+    return rss_pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, len(os.listdir("/proc/self/fd"))
+
+
+def lost_solves(database_path):
+    """
+    Return number of solves missing between the delivered solves of every member (solves are numbered).
+    """
+
+    database = sqlite3.connect(database_path)
+    member_solves = {}
+    for member_id, name in database.execute("SELECT member_id, name FROM member_solves"):
+        member_solves.setdefault(member_id, []).append(int(name[len("Soak"):]))
+    database.close()
+
+    return sum(max(solves) - min(solves) + 1 - len(set(solves)) for solves in member_solves.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PWNgress soak test")
+    parser.add_argument("--font", required=True, help="TrueType font used for all texts")
+    parser.add_argument("--cycles", type=int, default=3000)
+    parser.add_argument("--members", type=int, default=5)
+    parser.add_argument("--solve-every", type=int, default=10, help="New solve every N polls of a member")
+    parser.add_argument("--ranking-every", type=int, default=100, help="Render ranking table every N cycles")
+    parser.add_argument("--image-format", default="png")
+    parser.add_argument("--polling-mode", default="member", choices=["member", "team"])
+    parser.add_argument("--burst-every", type=int, default=0,
+                        help="Members solve --burst-size more every N polls (more than one page, default off)")
+    parser.add_argument("--burst-size", type=int, default=45)
+    parser.add_argument("--fail-page-every", type=int, default=0,
+                        help="Every N-th request of an older activities page fails (default off)")
+    parser.add_argument("--warmup", type=int, default=0,
+                        help="Cycles before the baseline is taken (default cycles/4). With glibc the render threads "
+                             "fill their malloc arenas during the first ranking renders")
+    parser.add_argument("--max-rss-growth", type=float, default=10.0, help="Allowed RSS growth in MB after warmup")
+    parser.add_argument("--max-fd-growth", type=int, default=2, help="Allowed growth of open file descriptors")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="PWNgress-soak-")
+    images_dir = os.path.join(work_dir, "images")
+    create_fixture_images(images_dir)
+    database_path = os.path.join(work_dir, "PWNgress.sqlite")
+    with open("../database/schema.sql", "r") as schema_file:
+        schema_db = sqlite3.connect(database_path)
+        schema_db.executescript(schema_file.read())
+        schema_db.close()
+
+    stand_in = StandInAPI(args.members, args.solve_every, args.burst_every, args.burst_size, args.fail_page_every)
+    server = stand_in.serve()
+    server_url = "http://127.0.0.1:{}".format(server.server_address[1])
+    # Point all HTB requests and avatar URLs to the stand-in
+    htb_models.HTB_URL = server_url
+
+    pwngress = PWNgress("token", "1", server_url + "/webhook/team", server_url + "/webhook/alerts",
+                        args.font, args.font, "", args.font, args.font, args.font,
+                        image_format=args.image_format, images_dir=images_dir, polling_mode=args.polling_mode,
+                        log_path=os.path.join(work_dir, "PWNgress_events.log"), database_path=database_path)
+
+    warmup_cycles = args.warmup or max(args.cycles // 4, 1)
+    warmup_rss, warmup_fds = None, None
+    for cycle in range(1, args.cycles + 1):
+        pwngress.run_cycle()
+        if cycle % args.ranking_every == 0:
+            pwngress.run_weekly_ranking()
+
+        if cycle == warmup_cycles:
+            warmup_rss, warmup_fds = process_resources()
+        if cycle % max(args.cycles // 20, 1) == 0:
+            rss, fds = process_resources()
+            print("[+] cycle {:>6d}  rss {:>8.1f} MB  fds {:>4d}  webhooks {:>6d}".format(
+                cycle, rss, fds, stand_in.webhook_requests
+            ))
+
+    rss, fds = process_resources()
+    server.shutdown()
+
+    print("[+] RSS after warmup {:.1f} MB, at the end {:.1f} MB".format(warmup_rss, rss))
+    print("[+] FDs after warmup {}, at the end {}".format(warmup_fds, fds))
+    if rss - warmup_rss > args.max_rss_growth or fds - warmup_fds > args.max_fd_growth:
+        print("[-] ERROR: Resource usage is growing")
+        sys.exit(1)
+    print("[+] Resource usage is flat")
+
+    lost_count = lost_solves(database_path)
+    print("[+] Older pages requested {}, failed {}".format(stand_in.page_requests, stand_in.failed_pages))
+    if lost_count:
+        print("[-] ERROR: {} solves were not delivered".format(lost_count))
+        sys.exit(1)
+    print("[+] No solve was lost")
+
+
+if __name__ == "__main__":
+    main()
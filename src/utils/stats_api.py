@@ -0,0 +1,177 @@
+"""
+Read-only HTTP JSON API over the PWNgress database, so dashboards and chat commands can use the team data
+PWNgress already collected instead of requesting HTB. Responses are cached in memory until PWNgress writes
+new data (invalidate is called after every phase of the cycle).
+
+    GET /api/team                     latest team ranking and number of members
+    GET /api/team/history             all saved team rankings
+    GET /api/members                  team members
+    GET /api/members/<id>/history     weekly rankings of the member
+    GET /api/members/<id>/solves      latest solves of the member (?limit=N, default 20, max 100)
+    GET /api/solves                   latest solves of the team (?limit=N, default 20, max 100)
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import re
+import sqlite3
+import threading
+
+from utils import htb_models
+
+
+class StatsAPI():
+    """
+    Answers API requests from the database opened read-only with its own connection (SQLWizard connection
+    of the polling loop is not shared between threads).
+    """
+
+    def __init__(self, database_path):
+        self.db = sqlite3.connect("file:{}?mode=ro".format(database_path), uri=True, check_same_thread=False)
+        self.db_lock = threading.Lock()
+
+        self.cache_lock = threading.Lock()
+        self.cache = {}
+        self.max_cache_entries = 1000
+        self.generation = 0
+
+        self.routes = [
+            (r"/api/team", self.get_team),
+            (r"/api/team/history", self.get_team_history),
+            (r"/api/members", self.get_members),
+            (r"/api/members/(\d+)/history", self.get_member_history),
+            (r"/api/members/(\d+)/solves", self.get_member_solves),
+            (r"/api/solves", self.get_solves)
+        ]
+
+    def invalidate(self):
+        """
+        Drop cached responses. Called when PWNgress wrote to the database.
+        """
+
+        with self.cache_lock:
+            self.generation += 1
+            self.cache = {}
+
+    def query(self, sql, parameters=()):
+        """
+        Return rows of the query as list of dictionaries.
+        """
+
+        with self.db_lock:
+            cursor = self.db.execute(sql, parameters)
+            columns = [x[0] for x in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def get_team(self, limit):
+        team_rows = self.query(
+            "SELECT rank_date, rank, points, user_owns, system_owns, challenge_owns, respects "
+            "FROM team_ranking ORDER BY rank_date DESC LIMIT 1"
+        )
+        members_count = self.query("SELECT COUNT(*) AS members FROM htb_team_members")[0]["members"]
+
+        return {"ranking": team_rows[0] if team_rows else None, "members": members_count}
+
+    def get_team_history(self, limit):
+        return self.query(
+            "SELECT rank_date, rank, points, user_owns, system_owns, challenge_owns, respects "
+            "FROM team_ranking ORDER BY rank_date ASC"
+        )
+
+    def get_members(self, limit):
+        return self.query(
+            "SELECT id, htb_name, htb_avatar, points, rank, last_flag_date FROM htb_team_members ORDER BY points DESC"
+        )
+
+    def get_member_history(self, limit, member_id):
+        return self.query(
+            "SELECT rank_date, rank, points, user_owns, system_owns, challenge_owns, fortress_owns, endgame_owns, "
+            "prolabs_owns, user_bloods, system_bloods, respects FROM member_ranking WHERE id = ? "
+            "ORDER BY rank_date ASC",
+            (member_id,)
+        )
+
+    def get_member_solves(self, limit, member_id):
+        return self.query(
+            "SELECT member_id, member_name, solve_date, object_type, type, name, challenge_category, flag_title "
+            "FROM member_solves WHERE member_id = ? ORDER BY solve_date DESC LIMIT ?",
+            (member_id, limit)
+        )
+
+    def get_solves(self, limit):
+        return self.query(
+            "SELECT member_id, member_name, solve_date, object_type, type, name, challenge_category, flag_title "
+            "FROM member_solves ORDER BY solve_date DESC LIMIT ?",
+            (limit,)
+        )
+
+    def get_limit(self, query_args):
+        """
+        Return limit query parameter (default 20, 1 - 100).
+        """
+
+        try:
+            return min(max(int(query_args.get("limit", ["20"])[0]), 1), 100)
+        except ValueError:
+            return 20
+
+    def respond(self, request_path):
+        """
+        Return (status, JSON body) for GET request path. Successful responses are cached until invalidate,
+        keyed by the route, member id and limit, other query parameters are ignored.
+        """
+
+        url = urlsplit(request_path)
+        for route_pattern, route_function in self.routes:
+            route_match = re.fullmatch(route_pattern, url.path.rstrip("/"))
+            if route_match:
+                break
+        else:
+            return 404, htb_models.dumps({"error": "not found"}).encode()
+
+        route_args = [int(x) for x in route_match.groups()]
+        limit = self.get_limit(parse_qs(url.query))
+        cache_key = (route_pattern, tuple(route_args), limit)
+
+        with self.cache_lock:
+            cached_response = self.cache.get(cache_key)
+            generation = self.generation
+        if cached_response:
+            return cached_response
+
+        try:
+            response = (200, htb_models.dumps(route_function(limit, *route_args)).encode())
+        except sqlite3.Error as err:
+            return 503, htb_models.dumps({"error": str(err)}).encode()
+
+        with self.cache_lock:
+            # Don't cache a response read before the database changed. Requests for many member ids can't
+            # grow the cache without limit
+            if generation == self.generation and len(self.cache) < self.max_cache_entries:
+                self.cache[cache_key] = response
+
+        return response
+
+    def serve(self, host="0.0.0.0", port=8081):
+        """
+        Start API HTTP server in a daemon thread. Returns the server.
+        """
+
+        stats_api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = stats_api.respond(self.path)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, name="StatsAPI", daemon=True).start()
+
+        return server